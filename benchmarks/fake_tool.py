@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A stand-in for every tool and helper script silkflow runs, picking what to
+# do from the name it was invoked as. It reads and writes the same files as the
+# real thing, with realistic volumes of output (scaled by FAKE_SCALE), but does
+# no actual work. See stub_toolchain.py.
+import os
+import sys
+import shutil
+import tarfile
+
+KiB = 1024
+MiB = 1024 * KiB
+
+scale = float(os.getenv("FAKE_SCALE") or 1)
+
+def scaled(amount):
+    return max(1, int(amount * scale))
+
+def arg(argv, flag, default=None):
+    if flag not in argv:
+        return default
+    return argv[argv.index(flag) + 1]
+
+def write_data(path, size, template="%08i fake data for silkflow benchmarks\n"):
+    block = "".join(template % i for i in range(1024)).encode("utf-8")
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            chunk = block[:size - written]
+            f.write(chunk)
+            written += len(chunk)
+
+def copy(source, destination):
+    with open(source, "rb") as i, open(destination, "wb") as o:
+        shutil.copyfileobj(i, o)
+
+def chatter(count, streams, template):
+    for i in range(count):
+        line = template % i
+        for stream in streams:
+            stream.write(line)
+
+def top_module(argv):
+    return os.getenv("TOP") or "top"
+
+def yosys(argv):
+    script = arg(argv, "-p", "")
+    if "read_json" in script: # conv.tcl
+        write_data(os.environ["OUT_EBLIF"], scaled(2 * MiB), ".names n%i\n1 1\n")
+        return
+    write_data(os.environ["OUT_JSON"], scaled(4 * MiB), "\"cell_%i\": {},\n")
+    write_data(os.environ["OUT_SYNTH_V"], scaled(2 * MiB), "wire n%i;\n")
+    log = arg(argv, "-l")
+    if log is not None:
+        write_data(log, scaled(1 * MiB), "%i. Executing pass.\n")
+    for i in range(scaled(2000)):
+        if i % 50 == 0:
+            sys.stderr.write("Warning: wire n%i is used but has no driver.\n" % i)
+        else:
+            sys.stderr.write("Info: pass %i done\n" % i)
+
+def vpr(argv):
+    top = top_module(argv)
+    seed = int(arg(argv, "--seed", "1"))
+    stages = [stage for stage in ["--pack", "--place", "--route"] if stage in argv] or ["--pack", "--place", "--route"]
+    with open("vpr_stdout.log", "w") as log:
+        chatter(scaled(20000), [sys.stdout, log], "Info %i: VPR is doing something that takes a while\n")
+        if "--pack" in stages:
+            write_data(arg(argv, "--net_file", "%s.net" % top), scaled(4 * MiB), "<block name=\"n%i\" mode=\"default\"/>\n")
+        if "--place" in stages:
+            write_data("%s.place" % top, scaled(256 * KiB), "n%i 1 2 0 0 #1\n")
+            log.write("Placement estimated critical path delay (least slack): %.3f ns\n" % (10 - seed * 0.01))
+            log.write("BB estimate of min-dist (placement) wire length: %i\n" % (1000 + seed % 13))
+        if "--route" in stages:
+            write_data("%s.route" % top, scaled(8 * MiB), "Node: %i SOURCE (1,2) Class: 0 Switch: 0\n")
+            log.write("Total wirelength: %i, average net length: 3.5\n" % (2000 + seed % 11))
+            log.write("Final critical path delay (least slack): %.3f ns, Fmax: 100 MHz\n" % (9 - seed * 0.01))
+
+def genfasm(argv):
+    top = top_module(argv)
+    with open("vpr_stdout.log", "w") as log:
+        chatter(scaled(5000), [sys.stdout, log], "Info %i: genfasm is writing features\n")
+    write_data("%s.fasm" % top, scaled(16 * MiB), "CLBLL_L_X%i.SLICEL_X0.ALUT.INIT[0]\n")
+
+def pixz(argv):
+    if argv[0] == "-l":
+        with tarfile.open(argv[1], "r:xz") as archive:
+            for member in archive:
+                print(member.name + ("/" if member.isdir() else ""))
+        return
+    wanted = set(argv[1:])
+    found = set()
+    with tarfile.open(fileobj=sys.stdin.buffer, mode="r|xz", bufsize=MiB) as source, tarfile.open(fileobj=sys.stdout.buffer, mode="w|", bufsize=MiB) as output:
+        for member in source:
+            if len(wanted) == 0 or member.name in wanted:
+                found.add(member.name)
+                output.addfile(member, source.extractfile(member) if member.isfile() else None)
+    if len(wanted - found) != 0:
+        sys.stderr.write("pixz: %s not found\n" % ", ".join(sorted(wanted - found)))
+        sys.exit(1)
+
+def icepack(argv):
+    with open(argv[0], "rb") as f:
+        while len(f.read(MiB)) != 0:
+            pass
+    sys.stdout.buffer.write(b"\xff\x00" * scaled(128 * KiB))
+
+def xcfasm(argv):
+    with open(arg(argv, "--fn_in"), "rb") as f:
+        while len(f.read(MiB)) != 0:
+            pass
+    write_data(arg(argv, "--bit_out"), scaled(4 * MiB), "%08x")
+
+def prjxray_config(argv):
+    print(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "prjxray-db"))
+
+def conda(argv):
+    pass
+
+def split_inouts(argv):
+    copy(arg(argv, "-i"), arg(argv, "-o"))
+
+def ice40_create_ioplace(argv):
+    write_data(arg(argv, "--out"), scaled(4 * KiB), "io_%i 1 2 0\n")
+
+def prjxray_create_ioplace(argv):
+    chatter(scaled(200), [sys.stdout], "io_%i 1 2 0\n")
+
+def prjxray_create_place_constraints(argv):
+    chatter(scaled(200), [sys.stdout], "cluster_%i 1 2 0\n")
+
+def fasm2asc(argv):
+    with open(argv[-2], "rb") as f:
+        while len(f.read(MiB)) != 0:
+            pass
+    write_data(argv[-1], scaled(2 * MiB), ".logic_tile %i 1\n")
+
+tools = {
+    "yosys": yosys,
+    "vpr": vpr,
+    "genfasm": genfasm,
+    "pixz": pixz,
+    "icepack": icepack,
+    "xcfasm": xcfasm,
+    "prjxray-config": prjxray_config,
+    "conda": conda,
+    "icebox.py": conda,
+    "split_inouts.py": split_inouts,
+    "ice40_create_ioplace.py": ice40_create_ioplace,
+    "prjxray_create_ioplace.py": prjxray_create_ioplace,
+    "prjxray_create_place_constraints.py": prjxray_create_place_constraints,
+    "fasm2asc.py": fasm2asc,
+}
+
+if __name__ == '__main__':
+    tools[os.path.basename(sys.argv[0])](sys.argv[1:])
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures silkflow's own overhead, per command, against the fake toolchain
+# in stub_toolchain.py, and compares it to a stored baseline:
+#
+#   * cpu: silkflow's own user + system time, not counting the tools it runs
+#   * own: wall time minus the wall time of the tools it runs
+#   * rss: silkflow's own peak RSS
+#   * processes: the number of processes silkflow started
+#
+# Times are stored in units of a bare interpreter startup on the same machine,
+# so a baseline recorded on one box is meaningful on another.
+#
+#   python3 benchmarks/overhead.py [--arch ice40|xc7] [--runs N] [--update-baseline]
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import stub_toolchain
+
+here = os.path.dirname(os.path.abspath(__file__))
+default_baseline = os.path.join(here, "baseline.json")
+
+# Runs silkflow in-process, then writes what it measured about itself to
+# SILKFLOW_BENCH_REPORT on exit.
+probe = """
+import os, sys, json, atexit, resource, runpy
+def report():
+    profiling = sys.modules.get("silkflow.profiling")
+    records = profiling.records if profiling is not None else []
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    with open(os.environ["SILKFLOW_BENCH_REPORT"], "w") as f:
+        json.dump({
+            "cpu": usage.ru_utime + usage.ru_stime,
+            "max_rss_kib": usage.ru_maxrss,
+            "processes": len(records),
+            "children_wall": sum(record["wall"] for record in records)
+        }, f)
+atexit.register(report)
+sys.argv = ["silkflow"] + sys.argv[1:]
+runpy.run_module("silkflow", run_name="__main__", alter_sys=True)
+"""
+
+def cases(arch, root):
+    target = stub_toolchain.targets[arch]
+    device = ["-D", target["device"], "-P", target["part"]]
+    pxray = ["-X", target["pxray_device"]] if target["pxray_device"] is not None else []
+    constraints = ["-p", "top.pcf"] if arch == "ice40" else []
+    xdc = ["-x", "top.xdc"] if arch == "xc7" else []
+    vpr = ["-t", "top"] + device + ["-e", "top.eblif", "-n", "top.net"] + constraints
+    full = ["-t", "top", "-b", "top.bit"] + device + pxray + constraints + xdc
+    setup_dir = os.path.join(root, "setup")
+
+    # (name, argv, preparation): preparation gets a function running silkflow
+    # with the given arguments
+    return [
+        ("synth", ["synth", "-t", "top"] + device + pxray + xdc + ["top.v"], None),
+        ("pack", ["pack"] + vpr, None),
+        ("generate_constraints", ["generate_constraints"] + vpr, None),
+        ("place", ["place"] + vpr, None),
+        ("route", ["route"] + vpr, None),
+        ("write_fasm", ["write_fasm"] + vpr, None),
+        ("write_bitstream", ["write_bitstream", "-t", "top", "-D", target["device"], "-P", target["part"], "-b", "top.bit", "-f", "top.fasm"] + pxray, None),
+        ("run", ["run", "--no-cache"] + full + ["top.v"], None),
+        ("run (cached)", ["run", "--cache"] + full + ["top.v"], lambda silkflow: silkflow(["run", "--cache"] + full + ["top.v"])),
+        ("setup", ["setup", "-i", setup_dir, "-f", arch, stub_toolchain.archive_path(root)], lambda silkflow: shutil.rmtree(setup_dir, ignore_errors=True)),
+    ]
+
+def measure(argv, env, cwd):
+    fd, report = tempfile.mkstemp(prefix="silkflow-bench-", suffix=".json")
+    os.close(fd)
+    try:
+        run_env = env.copy()
+        run_env["SILKFLOW_BENCH_REPORT"] = report
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-c", probe] + argv, env=run_env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        wall = time.perf_counter() - start
+        if process.returncode != 0:
+            sys.stderr.write(process.stderr.decode("utf-8", errors="replace"))
+            raise Exception("silkflow %s failed (%i)" % (" ".join(argv), process.returncode))
+        with open(report) as f:
+            result = json.load(f)
+    finally:
+        os.unlink(report)
+    result["wall"] = wall
+    result["own"] = max(0.0, wall - result.pop("children_wall"))
+    return result
+
+def calibrate(runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def benchmark(arch, runs, scale, unit):
+    root = tempfile.mkdtemp(prefix="silkflow-bench-%s-" % arch)
+    try:
+        env = stub_toolchain.create(root, arch, scale)
+        project = stub_toolchain.project_path(root)
+        measurements = {}
+        for name, argv, prepare in cases(arch, root):
+            best = None
+            for _ in range(runs):
+                if prepare is not None:
+                    prepare(lambda argv: measure(argv, env, project))
+                result = measure(argv, env, project)
+                if best is None:
+                    best = result
+                else:
+                    best = {key: min(best[key], value) for key, value in result.items()}
+            measurements[name] = {
+                "cpu": round(best["cpu"] / unit, 3),
+                "own": round(best["own"] / unit, 3),
+                "max_rss_kib": best["max_rss_kib"],
+                "processes": best["processes"]
+            }
+        return measurements
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+# Returns a list of regressions
+def compare(current, baseline, tolerance):
+    regressions = []
+    for metric in ["cpu", "own"]:
+        # Times are noisy on shared machines: an absolute slack of an
+        # interpreter startup on top of the tolerance keeps the quickest
+        # commands from flagging spuriously.
+        if current[metric] > baseline[metric] * (1 + tolerance) + 1:
+            regressions.append("%s %.2f > %.2f" % (metric, current[metric], baseline[metric]))
+    if current["max_rss_kib"] > baseline["max_rss_kib"] * 1.1 + 1024:
+        regressions.append("rss %.1fMiB > %.1fMiB" % (current["max_rss_kib"] / 1024, baseline["max_rss_kib"] / 1024))
+    if current["processes"] > baseline["processes"]:
+        regressions.append("processes %i > %i" % (current["processes"], baseline["processes"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="silkflow overhead benchmarks against a fake toolchain")
+    parser.add_argument("--arch", action="append", choices=sorted(stub_toolchain.targets.keys()), help="Architecture(s) to benchmark (default: all)")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per command: the best one is kept")
+    parser.add_argument("--scale", type=float, default=1, help="Scale factor for the fake tools' output and file sizes")
+    parser.add_argument("--baseline", default=default_baseline, help="Baseline file to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="Allowed relative regression of CPU and wall time: timings on shared CI machines easily vary by half")
+    parser.add_argument("--update-baseline", action="store_true", default=False, help="Record the results as the new baseline instead of comparing")
+    args = parser.parse_args()
+
+    unit = calibrate(10)
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = {}
+    if not args.update_baseline and baseline.get("scale", 1) != args.scale:
+        print("The baseline was recorded with --scale %s." % baseline.get("scale", 1))
+        sys.exit(2)
+
+    failed = False
+    results = {"scale": args.scale}
+    print("Times are in interpreter startups (1 = %.1fms)." % (unit * 1000))
+    print("%-6s %-22s %8s %8s %10s %10s" % ("Arch", "Command", "CPU", "Own", "RSS (MiB)", "Processes"))
+    for arch in args.arch or sorted(stub_toolchain.targets.keys()):
+        results[arch] = benchmark(arch, args.runs, args.scale, unit)
+        for name, current in results[arch].items():
+            print("%-6s %-22s %8.2f %8.2f %10.1f %10i" % (arch, name, current["cpu"], current["own"], current["max_rss_kib"] / 1024, current["processes"]))
+            recorded = baseline.get(arch, {}).get(name)
+            if args.update_baseline or recorded is None:
+                continue
+            regressions = compare(current, recorded, args.tolerance)
+            if len(regressions) != 0:
+                print("  REGRESSION: %s" % ", ".join(regressions))
+                failed = True
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+            f.write("\n")
+        print("Baseline written to %s." % args.baseline)
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
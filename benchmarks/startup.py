@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Guards silkflow's startup time: fails if a command imports modules it has no
+# use for, or if silkflow's startup overhead on top of the interpreter's own
+# exceeds a budget.
+#
+#   python3 benchmarks/startup.py [--runs N] [--budget-ms MS]
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# argv: modules that must not have been imported once it's been parsed
+cases = [
+    (["--version"], ["silkflow.flow", "silkflow.install", "silkflow.util", "halo", "asyncio", "tarfile", "concurrent.futures"]),
+    (["--help"], ["silkflow.flow", "silkflow.install", "silkflow.util", "halo", "asyncio", "tarfile", "concurrent.futures"]),
+    (["synth", "--help"], ["silkflow.install", "halo", "asyncio", "tarfile", "concurrent.futures"]),
+    (["run", "--help"], ["silkflow.install", "halo", "asyncio", "tarfile", "concurrent.futures"]),
+]
+
+# Runs the CLI in-process with the given arguments, then prints the modules
+# that were imported as JSON.
+probe = """
+import sys, json
+from silkflow.cli import cli
+try:
+    cli(sys.argv[1:], prog_name="silkflow")
+except SystemExit:
+    pass
+print(json.dumps(sorted(sys.modules.keys())), file=sys.stderr)
+"""
+
+def environment():
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [repository, env.get("PYTHONPATH")]))
+    return env
+
+def imported_modules(args):
+    process = subprocess.run([sys.executable, "-c", probe] + args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=environment(), check=True)
+    return json.loads(process.stderr.decode("utf-8").strip().split("\n")[-1])
+
+def best_time(cmd, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=environment(), check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description="silkflow startup-time guard")
+    parser.add_argument("--runs", type=int, default=10, help="Runs per command: the fastest one is kept")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("SILKFLOW_STARTUP_BUDGET_MS") or 150), help="Maximum startup overhead over a bare interpreter")
+    args = parser.parse_args()
+
+    failed = False
+
+    interpreter = best_time([sys.executable, "-c", "pass"], args.runs)
+    print("%-24s %10s %14s" % ("Command", "Time (ms)", "Overhead (ms)"))
+    print("%-24s %10.1f %14s" % ("python3 -c pass", interpreter * 1000, "-"))
+    for argv, forbidden in cases:
+        name = " ".join(argv)
+
+        elapsed = best_time([sys.executable, "-m", "silkflow"] + argv, args.runs)
+        overhead = (elapsed - interpreter) * 1000
+        print("%-24s %10.1f %14.1f" % (name, elapsed * 1000, overhead))
+        if overhead > args.budget_ms:
+            print("  FAIL: over the %.0fms budget" % args.budget_ms)
+            failed = True
+
+        unexpected = sorted(set(forbidden) & set(imported_modules(argv)))
+        if len(unexpected) != 0:
+            print("  FAIL: imports %s" % ", ".join(unexpected))
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lays out a fake Symbiflow install, backed by fake_tool.py, that silkflow can
+# run every command against: tools on PATH, an install base with architecture
+# files and helper scripts, the same install as a pixz archive for setup, and
+# a project to run the flow on.
+import os
+import stat
+import shutil
+import tarfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+repository = os.path.dirname(here)
+
+fake_tool = os.path.join(here, "fake_tool.py")
+
+tools = ["yosys", "vpr", "genfasm", "pixz", "icepack", "xcfasm", "prjxray-config", "conda", "icebox.py"]
+
+# The project silkflow gets run on, per architecture
+targets = {
+    "ice40": {
+        "device": "hx8k-ct256",
+        "part": "hx8k-ct256",
+        "pxray_device": None,
+        "constraints": ("top.pcf", "set_io clk J3\nset_io led B5\n")
+    },
+    "xc7": {
+        "device": "xc7a50t_test",
+        "part": "xc7a35tcsg324-1",
+        "pxray_device": "artix7",
+        "constraints": ("top.xdc", "set_property PACKAGE_PIN E3 [get_ports clk]\nset_property PACKAGE_PIN H5 [get_ports led]\n")
+    }
+}
+
+def install_files(arch, target):
+    device_underscored = "_".join(target["device"].split("-"))
+    if arch == "ice40":
+        device_dotted = ".".join(target["device"].split("-"))
+        return {
+            "devices/ice40/top-routing-virt/arch.timing.xml": 512 * 1024,
+            "devices/ice40/rr_graph_%s.rr_graph.real.bin" % device_underscored: 8 * 1024 * 1024,
+            "devices/ice40/rr_graph_%s.place_delay.bin" % device_underscored: 256 * 1024,
+            "devices/ice40/layouts/icebox/%s.pinmap.csv" % device_dotted: 16 * 1024,
+            "scripts/ice40/yosys/synth.tcl": 4 * 1024,
+            "scripts/ice40/yosys/conv.tcl": 1024,
+            "scripts/split_inouts.py": None,
+            "scripts/ice40/ice40_create_ioplace.py": None,
+            "scripts/ice40/fasm_icebox/fasm2asc.py": None
+        }
+    arch_dir = "arch/%s" % device_underscored
+    return {
+        "%s/arch.timing.xml" % arch_dir: 2 * 1024 * 1024,
+        "%s/rr_graph_%s.rr_graph.real.bin" % (arch_dir, device_underscored): 32 * 1024 * 1024,
+        "%s/rr_graph_%s.place_delay.bin" % (arch_dir, device_underscored): 512 * 1024,
+        "%s/vpr_grid_map.csv" % arch_dir: 1024 * 1024,
+        "%s/%s/pinmap.csv" % (arch_dir, target["part"]): 64 * 1024,
+        "techmaps/xc7_vpr/techmap/cells_map.v": 64 * 1024,
+        "scripts/xc7/synth.tcl": 4 * 1024,
+        "scripts/xc7/conv.tcl": 1024,
+        "scripts/lib/__init__.py": 0,
+        "scripts/split_inouts.py": None,
+        "scripts/prjxray_create_ioplace.py": None,
+        "scripts/prjxray_create_place_constraints.py": None
+    }
+
+def make_executable(path):
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+def write_filler(path, size):
+    line = b"# fake architecture data for silkflow benchmarks\n"
+    with open(path, "wb") as f:
+        while size > 0:
+            chunk = line[:size]
+            f.write(chunk)
+            size -= len(chunk)
+
+# Returns the environment to run silkflow with: everything is created under
+# root, which should be empty.
+def create(root, arch, scale=1):
+    target = targets[arch]
+    root = os.path.abspath(root)
+
+    bin_dir = os.path.join(root, "bin")
+    os.makedirs(bin_dir)
+    shutil.copy(fake_tool, os.path.join(bin_dir, "fake_tool.py"))
+    make_executable(os.path.join(bin_dir, "fake_tool.py"))
+    for tool in tools:
+        os.symlink("fake_tool.py", os.path.join(bin_dir, tool))
+
+    family_dir = os.path.join(root, "install", arch)
+    base = os.path.join(family_dir, "install")
+    share = os.path.join(base, "share", "symbiflow")
+    for relative, size in install_files(arch, target).items():
+        path = os.path.join(share, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if size is None: # A helper script
+            shutil.copy(fake_tool, path)
+        else:
+            write_filler(path, int(size * scale))
+    with open(os.path.join(family_dir, "environment.yml"), "w") as f:
+        f.write("name: %s\ndependencies:\n  - python=3.7\n" % arch)
+    os.makedirs(os.path.join(root, "prjxray-db", "artix7"), exist_ok=True)
+
+    with tarfile.open(os.path.join(root, "toolchain.tar.xz"), "w:xz", preset=0) as archive:
+        for name in sorted(os.listdir(family_dir)):
+            archive.add(os.path.join(family_dir, name), arcname=name)
+
+    project = os.path.join(root, "top")
+    os.makedirs(project)
+    with open(os.path.join(project, "top.v"), "w") as f:
+        f.write("module top(input clk, output led);\n    assign led = clk;\nendmodule\n")
+    constraints, contents = target["constraints"]
+    with open(os.path.join(project, constraints), "w") as f:
+        f.write(contents)
+
+    env = os.environ.copy()
+    env["PATH"] = os.pathsep.join([bin_dir, env.get("PATH") or ""])
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [repository, env.get("PYTHONPATH")]))
+    env["SYMBIFLOW_ARCH"] = arch
+    env["SYMBIFLOW_BASE"] = base
+    env["SILKFLOW_CACHE_DIR"] = os.path.join(root, "cache")
+    env["FAKE_SCALE"] = str(scale)
+    env.pop("SILKFLOW_PIXZ_ARCHIVE", None)
+    return env
+
+def archive_path(root):
+    return os.path.join(os.path.abspath(root), "toolchain.tar.xz")
+
+def project_path(root):
+    return os.path.join(os.path.abspath(root), "top")
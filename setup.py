@@ -23,8 +23,8 @@ import platform
 
 from silkflow.__init__ import __version__
 
-if sys.version_info < (3,5):
-    sys.exit('Python 3.5+ is required')
+if sys.version_info < (3,7):
+    sys.exit('Python 3.7+ is required')
 
 kwargs = dict(
     name='silkflow',
@@ -0,0 +1,195 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from .util import eprint, mkdirp, parse_size
+from . import history
+
+import os
+import json
+import time
+import fcntl
+import tempfile
+import itertools
+
+# Stages whose peak RSS is that of VPR (or genfasm) loading the device's
+# routing resource graph
+VPR_STAGES = ["pack", "place", "route", "pack_place", "place_route", "pack_place_route", "genfasm"]
+
+# Without history for a device, VPR's peak RSS is estimated from the size of
+# its rr_graph_*.real.bin: the in-memory graph is a few times larger.
+RR_GRAPH_FACTOR = 3
+BASE_ESTIMATE = 256 * 1024 * 1024
+
+# Leaves this much room for estimates being off
+HISTORY_MARGIN = 1.2
+
+POLL_INTERVAL = 1.0
+
+def physical_memory():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return None
+
+# Where the reservations of this user's processes on this host are kept. Not
+# in the cache directory, which may be shared between hosts: reservations are
+# told apart and checked for liveness by pid.
+def ledger_directory():
+    runtime = os.getenv("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "silkflow", "admission")
+    shm = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(shm, "silkflow-%i" % os.getuid(), "admission")
+
+# Host-wide memory admission for VPR and genfasm, which can each take
+# gigabytes just to load a large device's routing resource graph.
+#
+# Before running, every invocation reserves its estimated peak memory in a
+# ledger shared by all of the user's silkflow processes on the host (seed
+# sweeps, the targets of a multi-target run, serve workers and unrelated runs
+# alike), and waits while the reservations already in there leave no room for
+# it within the budget. An invocation larger than the whole budget is admitted once it
+# would run alone.
+#
+# Reservations are files named after the reserving process, so those of a
+# process that died without releasing them are dropped on the next look.
+class MemoryBudget(object):
+    def __init__(self, budget, path=None):
+        self.root = path or ledger_directory()
+        self.budget = budget
+        self.counter = itertools.count()
+
+    # SILKFLOW_MEMORY_BUDGET is the budget (e.g. 48G), by default 80% of the
+    # host's physical memory. SILKFLOW_MEMORY_BUDGET=off disables admission.
+    @staticmethod
+    def from_environment():
+        setting = os.getenv("SILKFLOW_MEMORY_BUDGET") or ""
+        if setting.lower() in ["off", "0", "none"]:
+            return None
+        if setting != "":
+            return MemoryBudget(parse_size(setting))
+        memory = physical_memory()
+        if memory is None:
+            return None
+        return MemoryBudget(int(memory * 0.8))
+
+    # Returns the total reserved and the number of reservations, dropping
+    # those of dead processes. Call with the lock held.
+    def reserved(self):
+        total = 0
+        count = 0
+        for name in os.listdir(self.root):
+            if not name.endswith(".reservation"):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                os.kill(int(name.split(".")[0]), 0)
+            except ProcessLookupError:
+                os.unlink(path)
+                continue
+            except (ValueError, PermissionError):
+                pass
+            try:
+                with open(path) as f:
+                    total += json.load(f)["bytes"]
+                count += 1
+            except (OSError, ValueError, KeyError):
+                continue
+        return total, count
+
+    # Returns a Reservation, or None if amount doesn't fit right now
+    def try_reserve(self, amount, label):
+        mkdirp(self.root)
+        with open(os.path.join(self.root, "lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            total, count = self.reserved()
+            if count != 0 and total + amount > self.budget:
+                return None
+            path = os.path.join(self.root, "%i.%i.reservation" % (os.getpid(), next(self.counter)))
+            with open(path, "w") as f:
+                json.dump({"bytes": amount, "label": label, "time": time.time()}, f)
+            return Reservation(path)
+
+    def waiting(self, amount, label):
+        eprint("Waiting for %i MiB of memory to run %s (budget: %i MiB, see SILKFLOW_MEMORY_BUDGET)…" % (amount / 1024 ** 2, label, self.budget / 1024 ** 2))
+
+    def reserve(self, amount, label):
+        reservation = self.try_reserve(amount, label)
+        if reservation is None:
+            self.waiting(amount, label)
+        while reservation is None:
+            time.sleep(POLL_INTERVAL)
+            reservation = self.try_reserve(amount, label)
+        return reservation
+
+    async def areserve(self, amount, label):
+        import asyncio # Only needed here, and slow to import
+        reservation = self.try_reserve(amount, label)
+        if reservation is None:
+            self.waiting(amount, label)
+        while reservation is None:
+            await asyncio.sleep(POLL_INTERVAL)
+            reservation = self.try_reserve(amount, label)
+        return reservation
+
+class Reservation(object):
+    def __init__(self, path):
+        self.path = path
+
+    def release(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+# The budget for this process: None if admission is disabled
+budget = MemoryBudget.from_environment()
+
+# Estimated peak RSS in bytes of VPR or genfasm on a device: the largest seen
+# in recent runs, or failing that, going by the size of its rr_graph
+def estimate(device, rr_graph):
+    peak = history.peak_rss(device, VPR_STAGES)
+    if peak is not None:
+        return int(peak * 1024 * HISTORY_MARGIN)
+    try:
+        return BASE_ESTIMATE + RR_GRAPH_FACTOR * os.path.getsize(rr_graph)
+    except OSError:
+        return BASE_ESTIMATE
+
+class Unlimited(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def release(self):
+        pass
+
+def admit(device, rr_graph, label):
+    if budget is None:
+        return Unlimited()
+    return budget.reserve(estimate(device, rr_graph), label)
+
+async def aadmit(device, rr_graph, label):
+    if budget is None:
+        return Unlimited()
+    return await budget.areserve(estimate(device, rr_graph), label)
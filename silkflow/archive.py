@@ -0,0 +1,93 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from .util import r, mkdirp, cache_dir
+
+import os
+import json
+import hashlib
+import tempfile
+
+# An on-disk index of the members of a pixz archive, built once per archive
+# and reused by every later invocation.
+#
+# pixz -l only lists member names: sizes are filled in from the tar headers as
+# members get extracted, and content digests as they are added to the ArchStore.
+# Offsets are not recorded, as pixz seeks to the right blocks using its own
+# index.
+class ArchiveIndex(object):
+    def __init__(self, archive):
+        self.archive = os.path.realpath(archive)
+
+        stat = os.stat(self.archive)
+        identity = hashlib.sha256(("%s:%i:%i" % (self.archive, stat.st_size, stat.st_mtime_ns)).encode("utf-8")).hexdigest()
+        self.path = cache_dir("archives", "%s.json" % identity[:32])
+
+        self.members = None
+        self.digests = {}
+
+    def load(self):
+        if self.members is not None:
+            return self
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            self.members = saved["members"]
+            self.digests = saved.get("digests") or {}
+        except (OSError, ValueError, KeyError):
+            self.build()
+        return self
+
+    def build(self):
+        listing = r(["pixz", "-l", self.archive], pipe_stdout=True).strip().split("\n")
+        self.members = {}
+        for name in listing:
+            if name == "" or name.endswith("/"):
+                continue
+            self.members[name] = None
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        mkdirp(directory)
+        fd, temporary = tempfile.mkstemp(prefix=".index-", dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump({
+                "archive": self.archive,
+                "members": self.members,
+                "digests": self.digests
+            }, f)
+        os.replace(temporary, self.path)
+
+    def names(self):
+        return self.load().members.keys()
+
+    def size(self, name):
+        return self.load().members.get(name)
+
+    # Records the size of an extracted member from its tar header
+    def record(self, member):
+        if not member.isfile():
+            return
+        self.load().members[member.name] = member.size
+
+    def digest(self, name):
+        return self.load().digests.get(name)
+
+    def record_digest(self, name, digest):
+        self.load().digests[name] = digest
+
+    def __contains__(self, name):
+        return name in self.load().members
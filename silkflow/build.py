@@ -0,0 +1,145 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from .util import eprint, hash_file, mkdirp
+
+import os
+import json
+import tempfile
+import threading
+import concurrent.futures
+
+# A step of the flow. inputs and outputs are file paths: a node depends on
+# whichever nodes produce its inputs. key_fn returns a StageKey covering
+# everything the node's outputs depend on (file contents, options, tools.)
+class Node(object):
+    def __init__(self, name, inputs, outputs, key_fn, action):
+        self.name = name
+        self.inputs = list(filter(lambda x: x is not None, inputs))
+        self.outputs = outputs
+        self.key_fn = key_fn
+        self.action = action
+
+# Make-style incremental builds using content hashes rather than mtimes.
+#
+# The key and output hashes of every node built are kept in a state file; a
+# node is rebuilt only if its key changed or its outputs are missing or were
+# modified since. Nodes that do not depend on one another run concurrently.
+class BuildGraph(object):
+    def __init__(self, state_path=os.path.join(".silkflow", "build.json")):
+        self.state_path = state_path
+        self.nodes = []
+        self.lock = threading.Lock()
+        try:
+            with open(state_path) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+
+    def add(self, node):
+        self.nodes.append(node)
+        return node
+
+    def dependencies(self, node):
+        producers = {}
+        for other in self.nodes:
+            for output in other.outputs:
+                producers[os.path.normpath(output)] = other
+        dependencies = []
+        for path in node.inputs:
+            producer = producers.get(os.path.normpath(path))
+            if producer is not None and producer is not node and producer not in dependencies:
+                dependencies.append(producer)
+        return dependencies
+
+    def output_hashes(self, node):
+        hashes = {}
+        for output in node.outputs:
+            if os.path.isfile(output):
+                hashes[output] = hash_file(output)
+        return hashes
+
+    def up_to_date(self, node, key):
+        recorded = self.state.get(node.name)
+        if recorded is None or recorded["key"] != key:
+            return False
+        if len(recorded["outputs"]) == 0:
+            return False
+        for output, digest in recorded["outputs"].items():
+            if not os.path.isfile(output) or hash_file(output) != digest:
+                return False
+        return True
+
+    def save(self):
+        directory = os.path.dirname(self.state_path) or "."
+        mkdirp(directory)
+        fd, temporary = tempfile.mkstemp(prefix=".build-", dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(temporary, self.state_path)
+
+    # Inputs are only hashed once every node producing them has finished, so
+    # a rebuilt node with unchanged outputs doesn't trigger its dependents.
+    def build_node(self, node):
+        key = node.key_fn().hexdigest()
+        if self.up_to_date(node, key):
+            eprint("%s is up to date." % node.name)
+            return False
+
+        eprint("Building %s…" % node.name)
+        node.action()
+
+        with self.lock:
+            self.state[node.name] = {
+                "key": key,
+                "outputs": self.output_hashes(node)
+            }
+            self.save()
+        return True
+
+    # Returns the names of the nodes that were rebuilt.
+    def build(self, jobs=None):
+        dependencies = {node: self.dependencies(node) for node in self.nodes}
+        pending = list(self.nodes)
+        running = {}
+        done = set()
+        rebuilt = []
+        failure = None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            while len(pending) + len(running) != 0:
+                if failure is None:
+                    for node in list(pending):
+                        if all(map(lambda x: x in done, dependencies[node])):
+                            pending.remove(node)
+                            running[executor.submit(self.build_node, node)] = node
+                if len(running) == 0:
+                    break
+
+                finished, _ = concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    try:
+                        if future.result():
+                            rebuilt.append(node.name)
+                        done.add(node)
+                    except BaseException as e:
+                        failure = failure or e
+
+        if failure is not None:
+            raise failure
+        if len(pending) != 0:
+            raise Exception("Could not resolve the dependencies of %s." % ", ".join(map(lambda x: x.name, pending)))
+        return rebuilt
@@ -0,0 +1,161 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from .util import hash_file, mkdirp, cache_dir, parse_size
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+class StageKey(object):
+    def __init__(self, stage):
+        self.digest = hashlib.sha256()
+        self.add("stage", stage)
+
+    def add(self, label, value):
+        self.digest.update(("%s=%s\n" % (label, json.dumps(value, sort_keys=True))).encode("utf-8"))
+        return self
+
+    # Hashes the contents of a file (or records its absence.)
+    def add_file(self, label, path):
+        if path is None or not os.path.exists(path):
+            return self.add(label, None)
+        return self.add(label, hash_file(path))
+
+    def add_files(self, label, paths):
+        for i, path in enumerate(paths or []):
+            self.add_file("%s[%i]" % (label, i), path)
+        return self
+
+    # Fingerprints a file using its path, size and mtime rather than its
+    # contents, which is good enough for multi-gigabyte, read-only data such
+    # as rr_graphs.
+    def add_stat(self, label, path):
+        if path is None or not os.path.exists(path):
+            return self.add(label, None)
+        stat = os.stat(path)
+        return self.add(label, [os.path.realpath(path), stat.st_size, stat.st_mtime_ns])
+
+    def add_tool(self, tool):
+        return self.add_stat("tool:%s" % tool, shutil.which(tool))
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+class StageCache(object):
+    MANIFEST = "manifest.json"
+
+    def __init__(self, path=None, size_cap=None):
+        self.path = path or cache_dir("stages")
+        self.size_cap = parse_size(size_cap or os.getenv("SILKFLOW_CACHE_SIZE") or "10G")
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    # Copies the outputs of a previous run of the stage into the current
+    # directory. Outputs are matched by position rather than by name, as file
+    # names are derived from the project name. Returns False on a cache miss.
+    def restore(self, key, outputs):
+        entry = self.entry_path(key)
+        manifest_path = os.path.join(entry, StageCache.MANIFEST)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        present = manifest["present"]
+        if len(present) != 0 and max(present) >= len(outputs):
+            return False
+
+        try:
+            for i in present:
+                self.copy_atomic(os.path.join(entry, str(i)), outputs[i])
+        except OSError:
+            return False
+
+        os.utime(manifest_path) # Marks the entry as recently used
+        return True
+
+    def store(self, key, outputs):
+        entry = self.entry_path(key)
+        if os.path.exists(entry):
+            return
+
+        mkdirp(self.path)
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=self.path)
+        try:
+            present = []
+            size = 0
+            for i, output in enumerate(outputs):
+                if not os.path.isfile(output):
+                    continue
+                shutil.copy2(output, os.path.join(staging, str(i)))
+                present.append(i)
+                size += os.path.getsize(output)
+            with open(os.path.join(staging, StageCache.MANIFEST), "w") as f:
+                json.dump({
+                    "present": present,
+                    "size": size
+                }, f)
+            mkdirp(os.path.dirname(entry))
+            os.rename(staging, entry)
+        except OSError:
+            # Another builder sharing the cache got there first, or we ran out of space
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if prefix.startswith(".") or not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                manifest_path = os.path.join(prefix_path, key, StageCache.MANIFEST)
+                try:
+                    with open(manifest_path) as f:
+                        size = json.load(f)["size"]
+                    last_used = os.path.getmtime(manifest_path)
+                except (OSError, ValueError, KeyError):
+                    continue
+                entries.append((last_used, size, os.path.join(prefix_path, key)))
+        return entries
+
+    # Evicts least recently used entries until the cache fits the size cap
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(map(lambda x: x[1], entries))
+        for _, size, path in entries:
+            if total <= self.size_cap:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    @staticmethod
+    def copy_atomic(source, destination):
+        directory = os.path.dirname(os.path.abspath(destination))
+        fd, temporary = tempfile.mkstemp(prefix=".%s." % os.path.basename(destination), dir=directory)
+        os.close(fd)
+        try:
+            shutil.copy2(source, temporary)
+            os.replace(temporary, destination)
+        except OSError:
+            os.unlink(temporary)
+            raise
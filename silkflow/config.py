@@ -0,0 +1,55 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Per-project settings, from silkflow.json in the project directory. Every
+# top-level key is a section owned by one part of silkflow, e.g.:
+#
+#   {
+#       "vpr": {"profile": "fast", "profiles": {"fast": {"max_router_iterations": 80}}}
+#   }
+import os
+import json
+
+FILE_NAME = "silkflow.json"
+
+class ConfigError(Exception):
+    pass
+
+# Memoized for as long as the file doesn't change
+loaded = {}
+def project_config(directory="."):
+    path = os.path.abspath(os.path.join(directory, FILE_NAME))
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    if memo_key not in loaded:
+        try:
+            with open(path) as f:
+                config = json.load(f)
+        except ValueError as e:
+            raise ConfigError("%s is not valid JSON: %s" % (path, e))
+        if not isinstance(config, dict):
+            raise ConfigError("%s should contain an object." % path)
+        loaded[memo_key] = config
+    return loaded[memo_key]
+
+def section(name, directory="."):
+    value = project_config(directory).get(name) or {}
+    if not isinstance(value, dict):
+        raise ConfigError("\"%s\" in %s should be an object." % (name, FILE_NAME))
+    return value
@@ -14,7 +14,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
 import sys
 import os
 
@@ -47,9 +46,18 @@ class ErrorReporter(object):
         for entry in self.all:
             eprint(entry["message"])
         if os.getenv("PRINT_JSON_ERRORS") == "1":
+            import json
             print(json.dumps({
                 "errors": self.errors,
                 "warnings": self.warnings
             }))
         return self
 
+
+# The reporter shared by everything running in this process
+reporter = None
+def get_reporter():
+    global reporter
+    if reporter is None:
+        reporter = ErrorReporter()
+    return reporter
@@ -0,0 +1,141 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import re
+import heapq
+import shutil
+import tempfile
+import itertools
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Feature bits canonicalize_fasm keeps in memory at once (a few dozen MiB):
+# beyond that, they are sorted in runs spilled to disk and merged back.
+RUN_BITS = 250000
+
+feature_rx = re.compile(r"^\s*([A-Za-z_][\w.$]*)(?:\[\s*(\d+)\s*(?::\s*(\d+)\s*)?\])?\s*(?:=\s*([^\s{#]+))?\s*(\{.*\})?\s*$")
+value_rx = re.compile(r"^(?:(\d+)?'([bBoOdDhH]))?([0-9a-fA-F_]+)$")
+radixes = {"b": 2, "o": 8, "d": 10, "h": 16}
+
+class FASMSyntaxError(Exception):
+    def __init__(self, file, line_no, line):
+        self.file = file
+        self.line_no = line_no
+        self.line = line
+
+    def __str__(self):
+        return "%s:%i: invalid FASM line '%s'" % (self.file, self.line_no, self.line)
+
+def parse_value(value):
+    match = value_rx.match(value)
+    if match is None:
+        return None
+    radix = radixes[(match[2] or "d").lower()]
+    return int(match[3].replace("_", ""), radix)
+
+# Yields (feature, addressed, bit, value, line_no, annotation) for every bit
+# assigned in a FASM file, one line at a time. annotation is the line's
+# {…} annotation, or None.
+def feature_bits(path):
+    with open(path) as f:
+        for line_no, line in enumerate(f, start=1):
+            content = line.split("#", 1)[0].strip()
+            if content == "":
+                continue
+            match = feature_rx.match(content)
+            value = parse_value(match[4]) if match is not None and match[4] is not None else 1
+            if match is None or value is None:
+                raise FASMSyntaxError(path, line_no, line.rstrip("\n"))
+
+            feature = match[1]
+            addressed = match[2] is not None
+            high = int(match[2]) if addressed else 0
+            low = int(match[3]) if match[3] is not None else high
+            for bit in range(low, high + 1):
+                yield feature, addressed, bit, (value >> (bit - low)) & 1, line_no, match[5]
+
+# Appends extra to main, line by line, without reading either file into memory.
+def append_fasm(main, extra):
+    with open(main, "ab+") as out:
+        if out.tell() != 0:
+            out.seek(-1, os.SEEK_END)
+            if out.read(1) != b"\n":
+                out.write(b"\n")
+        with open(extra, "rb") as f:
+            shutil.copyfileobj(f, out, COPY_BUFFER_SIZE)
+
+# A run of sorted bit records spilled to disk by canonicalize_fasm
+def write_run(path, records):
+    with open(path, "w") as f:
+        for record in records:
+            f.write("%s\t%i\t%i\t%i\t%i\t%i\t%s\n" % record)
+
+def read_run(path):
+    with open(path) as f:
+        for line in f:
+            feature, bit, index, line_no, value, addressed, annotation = line.rstrip("\n").split("\t", 6)
+            yield feature, int(bit), int(index), int(line_no), int(value), int(addressed), annotation
+
+# Merges FASM files into output with every feature bit that is set listed
+# exactly once, in sorted order, with the last annotation given for it.
+#
+# Memory is bounded by run_bits: the bits are sorted in runs of that many,
+# spilled next to output, then merged (an external merge sort).
+#
+# Returns a list of conflicts (the same bit being both set and cleared) as
+# (feature, bit, (file, line), (previous file, previous line)) tuples, in the
+# order of the inputs; output is only written if there are none.
+def canonicalize_fasm(inputs, output, run_bits=RUN_BITS):
+    directory = os.path.dirname(os.path.abspath(output))
+    with tempfile.TemporaryDirectory(prefix=".%s." % os.path.basename(output), dir=directory) as scratch:
+        runs = []
+        pending = []
+        for index, path in enumerate(inputs):
+            for feature, addressed, bit, value, line_no, annotation in feature_bits(path):
+                pending.append((feature, bit, index, line_no, value, int(addressed), annotation or ""))
+                if len(pending) == run_bits:
+                    pending.sort()
+                    runs.append(os.path.join(scratch, "%i.run" % len(runs)))
+                    write_run(runs[-1], pending)
+                    pending = []
+        pending.sort()
+
+        conflicts = []
+        temporary = os.path.join(scratch, "canonical.fasm")
+        with open(temporary, "w") as f:
+            merged = heapq.merge(*map(read_run, runs), pending)
+            for (feature, bit), occurrences in itertools.groupby(merged, key=lambda x: (x[0], x[1])):
+                kept = None
+                addressed = False
+                for _, _, index, line_no, value, flag, annotation in occurrences: # In input order
+                    addressed = addressed or flag
+                    location = (inputs[index], line_no)
+                    if kept is not None and kept[0] != value:
+                        conflicts.append((feature, bit, location, kept[1]))
+                        continue
+                    kept = (value, location, annotation or (kept[2] if kept is not None else ""))
+                if kept[0] == 0 or len(conflicts) != 0:
+                    continue
+                f.write("%s%s%s\n" % (
+                    feature,
+                    "[%i]" % bit if addressed else "",
+                    " " + kept[2] if kept[2] else ""
+                ))
+
+        if len(conflicts) != 0:
+            return sorted(conflicts, key=lambda x: (inputs.index(x[2][0]), x[2][1]))
+        os.replace(temporary, output)
+    return conflicts
@@ -13,11 +13,25 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from .util import d2nt, r, extract_pixz
-
-from halo import Halo
+from .util import d2nt, mkdirp, extract_pixz
+from .archive import ArchiveIndex
+from .toolchain import Toolchain
+from .store import ArchStore
 
 import os
+import fcntl
+import shutil
+import tempfile
+
+def extraction_progress(spinner, text, index=None, on_member=None):
+    def progress(member, extracted):
+        if index is not None:
+            index.record(member)
+        if on_member is not None:
+            on_member(member)
+        if spinner is not None:
+            spinner.text = "%s (%.1f MiB)" % (text, extracted / (1024 * 1024))
+    return progress
 
 class FileManager(object):
     def __init__(self, symbiflow_base_dir, archive_realpath):
@@ -29,20 +43,84 @@ class FileManager(object):
         self.scripts = os.path.join(self.share, "scripts")
 
         self.archive_realpath = archive_realpath
-
-    def jit_extract(self, files):
+        self.archive_index = None
+
+        self.toolchain = Toolchain(self.base)
+        self.store = ArchStore.from_environment()
+        self.arch_info = {}
+        self.python_paths = {}
+
+    def get_archive_index(self):
+        if self.archive_index is None:
+            self.archive_index = ArchiveIndex(self.archive_realpath)
+        return self.archive_index
+
+    # Extracts all missing files in a single pixz pass.
+    #
+    # Several silkflow processes (or a prefetch thread and the flow) may do
+    # this at once: extraction is serialized with a lock file, and members are
+    # extracted to a staging directory then renamed into place, so a file that
+    # exists is always complete.
+    def jit_extract(self, files, spinner=True, started=None):
         if self.archive_realpath is None:
             return
         extract_path = os.path.dirname(self.base) # The reason for this is the base path points to family_path/install/
 
-        files_filtered = filter(lambda x: not os.path.exists(x), files)
-        relative_files = list(map(lambda x: os.path.relpath(x, extract_path), files_filtered))
-    
-        if len(relative_files) == 0:
+        missing = lambda: list(filter(lambda x: not os.path.exists(x), files))
+        if len(missing()) == 0:
             return
 
-        with Halo(text='Extracting arch info…', spinner='dots'):
-            extract_pixz(self.archive_realpath, extract_path, relative_files)
+        mkdirp(extract_path)
+        with open(os.path.join(extract_path, ".silkflow-extract.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            relative_files = list(map(lambda x: os.path.relpath(x, extract_path), missing())) # Someone else may have extracted them meanwhile
+            if len(relative_files) == 0:
+                return
+
+            index = self.get_archive_index()
+            for file in relative_files:
+                if file not in index:
+                    raise Exception("%s is not in %s." % (file, self.archive_realpath))
+
+            # Files another install of the same archive already extracted are
+            # linked in from the store, without decompressing anything
+            if self.store is not None:
+                relative_files = list(filter(lambda x: not self.store.checkout(index.digest(x), os.path.join(extract_path, x)), relative_files))
+                if len(relative_files) == 0:
+                    return
+
+            staging = tempfile.mkdtemp(prefix=".silkflow-extract-", dir=extract_path)
+            try:
+                def promote(member):
+                    if not member.isfile():
+                        return
+                    destination = os.path.join(extract_path, member.name)
+                    mkdirp(os.path.dirname(destination))
+                    os.replace(os.path.join(staging, member.name), destination)
+                    if self.store is not None:
+                        index.record_digest(member.name, self.store.ingest(destination))
+
+                text = 'Extracting arch info…'
+                halo = None
+                if spinner:
+                    from halo import Halo # Slow to import: only needed for the spinner
+                    halo = Halo(text=text, spinner='dots').start()
+                try:
+                    extract_pixz(self.archive_realpath, staging, relative_files, progress=extraction_progress(halo, text, index, on_member=promote), started=started)
+                finally:
+                    if halo is not None:
+                        halo.stop()
+            finally:
+                index.save()
+                shutil.rmtree(staging, ignore_errors=True)
+
+            if self.store is not None:
+                self.store.evict()
+
+    # Extracts every file a flow on this device needs ahead of time
+    def prefetch(self, arch, device, part=None, spinner=True, started=None):
+        self.jit_extract(self.get_device_files(arch, device, part), spinner=spinner, started=started)
 
     def get_techmap_path(self, arch):
         if arch == "xc7":
@@ -63,17 +141,15 @@ class FileManager(object):
             return os.path.join(self.scripts, arch, scr)
         return os.path.join(self.scripts, arch, "yosys", scr)
 
-    def get_arch_info(self, arch, device):
+    def get_arch_paths(self, arch, device):
         device_underscored = "_".join(device.split("-"))
 
         if arch == "ice40":
             arch_dir = os.path.join(self.devices, arch)
 
-            def pinmap(for_part): # This is a function as some other architectures factor the part in.
+            def pinmap_path(for_part): # This is a function as some other architectures factor the part in.
                 device_dotted = ".".join(device.split("-"))
-                device_pinmap = os.path.join(arch_dir, "layouts", "icebox", "%s.pinmap.csv" % device_dotted)
-                self.jit_extract([device_pinmap])
-                return device_pinmap
+                return os.path.join(arch_dir, "layouts", "icebox", "%s.pinmap.csv" % device_dotted)
 
             architecture_data = {
                 "definition": os.path.join(arch_dir, "top-routing-virt", "arch.timing.xml"),
@@ -81,19 +157,13 @@ class FileManager(object):
                 "place_delay": os.path.join(arch_dir, "rr_graph_%s.place_delay.bin" % device_underscored),
                 # "vpr_grid_map": os.path.join(arch_dir, "vpr_grid_map.csv"),
             }
-            
-            self.jit_extract(architecture_data.values())
-
-            architecture_data["pinmap"] = pinmap
 
-            return d2nt(architecture_data)
+            return architecture_data, pinmap_path
         elif arch == "xc7":
             arch_dir = os.path.join(self.share, "arch")
-            
-            def pinmap(for_part):
-                device_pinmap = os.path.join(arch_dir, device_underscored, for_part, "pinmap.csv")
-                self.jit_extract([device_pinmap])
-                return device_pinmap
+
+            def pinmap_path(for_part):
+                return os.path.join(arch_dir, device_underscored, for_part, "pinmap.csv")
 
             architecture_data = {
                 "definition": os.path.join(arch_dir, device_underscored, "arch.timing.xml"),
@@ -101,26 +171,55 @@ class FileManager(object):
                 "place_delay": os.path.join(arch_dir, device_underscored, "rr_graph_%s.place_delay.bin" % device_underscored),
                 "vpr_grid_map": os.path.join(arch_dir, device_underscored, "vpr_grid_map.csv")
             }
-            
-            self.jit_extract(architecture_data.values())
 
-            architecture_data["pinmap"] = pinmap
+            return architecture_data, pinmap_path
+        raise Exception("Architecture %s has no arch info." % arch)
+
+    # Every architecture file a flow on this device needs: passing the part
+    # also pulls in the pinmap.
+    def get_device_files(self, arch, device, part=None):
+        architecture_data, pinmap_path = self.get_arch_paths(arch, device)
+        files = list(architecture_data.values())
+        if part is not None:
+            files.append(pinmap_path(part))
+        return files
+
+    # Memoized once the files are known to be there
+    def get_arch_info(self, arch, device, part=None):
+        memo_key = (arch, device, part)
+        arch_info = self.arch_info.get(memo_key)
+        if arch_info is None:
+            arch_info = self.arch_info[memo_key] = self.resolve_arch_info(arch, device, part)
+        return arch_info
+
+    def resolve_arch_info(self, arch, device, part):
+        architecture_data, pinmap_path = self.get_arch_paths(arch, device)
+
+        self.jit_extract(self.get_device_files(arch, device, part))
+
+        def pinmap(for_part):
+            device_pinmap = pinmap_path(for_part)
+            self.jit_extract([device_pinmap])
+            return device_pinmap
+
+        architecture_data["pinmap"] = pinmap
 
-            return d2nt(architecture_data)
+        return d2nt(architecture_data)
 
     def get_python_path(self, arch):
+        if arch in self.python_paths:
+            return self.python_paths[arch]
         paths = [self.scripts, self.get_arch_script_folder(arch)]
         if arch == "ice40":
-            icebox_result = r([
-                "which",
-                "icebox.py"
-            ], pipe_stdout=True)
-            icebox_path = icebox_result.strip()
+            icebox_path = self.toolchain.which("icebox.py")
+            if icebox_path is None:
+                raise Exception("icebox.py was not found in PATH.")
             icebox_dir = os.path.dirname(icebox_path)
             paths.append(icebox_dir)
         elif arch == "xc7":
             paths.append(os.path.join(self.scripts, "lib"))
-        return ":".join(paths)
+        self.python_paths[arch] = ":".join(paths)
+        return self.python_paths[arch]
 
     def get_python_env(self, arch):
         env = os.environ.copy()
@@ -0,0 +1,1201 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .fasm import append_fasm, canonicalize_fasm, FASMSyntaxError
+from .vpr import run_genfasm, run_vpr, arun_vpr, device_base, get_options, parse_vpr_metrics
+from .watchdog import RouteAbandoned
+from .util import r, d2nt, mkdirp, NonZeroExit, DeferredInput, Fanout, Extraction, run_async
+from .cache import StageCache, StageKey
+from .file import FileManager
+from .workspace import Workspace, scratch_root, project_directory
+from .error import eprint, get_reporter
+from .config import ConfigError
+from . import profiling, helpers, history, retention, vpr
+
+import click
+
+import io
+import os 
+import re
+import glob
+import sys
+import shutil
+import tempfile
+import threading
+import subprocess
+import functools
+from timeit import default_timer as timer
+
+# Created when a flow command is first looked up (see cli.LazyGroup) rather
+# than when silkflow starts.
+arch = os.environ.get("SYMBIFLOW_ARCH") or "ice40"
+symbiflow_base_dir = os.getenv("SYMBIFLOW_BASE") or "/opt/symbiflow"
+
+fm = FileManager(symbiflow_base_dir, os.getenv("SILKFLOW_PIXZ_ARCHIVE"))
+er = get_reporter()
+current_project = os.path.basename(os.getcwd())
+history.enable() # Every stage run from here on goes in the run history
+
+def handle_yosys_stderr_line(line, input_files=[]):
+    file_error_rx = r"((?:[\w\.\-\:\/]+).v):(\d+)"
+    warning_line_rx = r"warning\s*\:\s*[\s\S]*"
+
+    if line.strip() == "":
+        return
+
+    warning = bool(re.match(warning_line_rx, line, flags=re.I))
+
+    message = line
+    file = None
+    line_no = None
+
+    result = re.match(file_error_rx, line)
+    if result is not None and result[1] in input_files:
+        file = result[1]
+        line_no = int(result[2])
+
+    er.add(warning, message, file, line_no)
+
+# Symbiflow's Python helper scripts run through a warm pool: see helpers.py
+def helper_pool(wait=False):
+    if wait:
+        return helpers.get_ready_pool(arch, lambda: fm.get_python_env(arch))
+    return helpers.get_pool(arch, lambda: fm.get_python_env(arch))
+
+def run_helper(cmd, env=None, stdout=None):
+    helpers.run_helper(arch, lambda: fm.get_python_env(arch), cmd, env=env, stdout=stdout)
+
+# Runs a helper with its standard output going straight to path, which is
+# only replaced once the helper succeeds
+def run_helper_to(path, cmd, env=None):
+    temporary = "%s.%i.partial" % (path, os.getpid())
+    try:
+        with open(temporary, "w") as f:
+            run_helper(cmd, env=env, stdout=f)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+def run_yosys_cmd(cmd, input_files=[], **kwargs):
+    try:
+        r(cmd, **kwargs, stream_stderr=True, on_line=lambda line: handle_yosys_stderr_line(line, input_files))
+    except NonZeroExit:
+        er.report()
+        exit(65)
+
+@profiling.staged("synth")
+def synth_fn(top_module, device, part, prxray_device, xdc_files, verilog_files):
+    COMMAND_NAME = "synth"
+
+    if type(xdc_files) == str:
+        xdc_files = xdc_files.split(":")
+
+    log_file = "%s_%s.log" % (current_project, COMMAND_NAME)
+    output_verilog = "%s_%s.v" % (current_project, COMMAND_NAME)
+    output_eblif = "%s.eblif" % (top_module)
+    output_json = "%s.raw.json" % (top_module)
+
+    # yosys runs from the project directory, even in a workspace, so that
+    # `include and $readmemh paths relative to it are still found. What it
+    # writes goes to the current directory all the same.
+    absolute = os.path.abspath
+    modified_env = os.environ.copy()
+    modified_env["OUT_JSON"] = absolute(output_json)
+    modified_env["OUT_SYNTH_V"] = absolute(output_verilog)
+    modified_env["OUT_EBLIF"] = absolute(output_eblif)
+    modified_env["TOP"] = top_module
+
+    if arch == "xc7":
+        modified_env["INPUT_XDC_FILE"] = " ".join(xdc_files)
+        modified_env["USE_ROI"] = "FALSE"
+        modified_env["TECHMAP_PATH"] = fm.get_techmap_path(arch)
+
+        database_dir = fm.toolchain.prjxray_db()
+        modified_env["PART_JSON"] = os.path.join(database_dir, prxray_device, part, "part.json")
+
+        modified_env["OUT_FASM_EXTRA"] = absolute("%s_fasm_extra.fasm" % top_module)
+        modified_env["OUT_SDC"] = absolute("%s.sdc" % top_module)
+
+        modified_env["PYTHON3"] = sys.executable
+        modified_env["UTILS_PATH"] = fm.scripts
+
+    helper_pool() # If the command uses one, it starts up while yosys runs
+
+    run_yosys_cmd([
+        "yosys",
+        "-Q", "-q",
+        "-p", "tcl %s" % fm.get_yosys_script(arch, "synth.tcl"),
+        "-l", absolute(log_file),
+        *verilog_files
+    ], env=modified_env, cwd=project_directory(), input_files=verilog_files)
+
+    final_output_json = "%s.json" % top_module
+    with profiling.stage("split_inouts"):
+        run_helper([
+            "python3",
+            fm.get_script("split_inouts.py"),
+            "-i", output_json,
+            "-o", final_output_json 
+        ], env=modified_env)
+
+    with profiling.stage("conv"):
+        run_yosys_cmd([
+            "yosys",
+            "-Q", "-q",
+            "-p", "read_json %s; tcl %s" % (final_output_json, fm.get_yosys_script(arch, "conv.tcl"))
+        ], env=modified_env)
+
+    return d2nt({
+        "raw_json": output_json,
+        "json": final_output_json,
+        "eblif": output_eblif
+    })
+
+@profiling.staged("pack")
+def pack_fn(top_module, device, eblif, part, pcf, net, sdc):
+    COMMAND_NAME = "pack"
+    
+    noisy_warnings_log = "%s_noisy_warnings_%s.log" % (current_project, COMMAND_NAME)
+    stdout_log = "%s_%s.log" % (current_project, COMMAND_NAME)
+    
+    run_vpr(top_module, arch, device, eblif, sdc, fm, ["--pack"], noisy_warnings_log, stdout_log)
+
+    return "%s.net" % top_module
+
+@profiling.staged("generate_constraints")
+def generate_constraints_fn(top_module, device, eblif, part, pcf, net, sdc):
+    COMMAND_NAME = "generate_constraints"
+
+    pcf_options = []
+    if pcf is not None:
+        pcf_options = ["--pcf", pcf]
+
+    arch_info = fm.get_arch_info(arch, device, part)
+    pin_map = arch_info.pinmap(for_part=part)
+
+    python_env = fm.get_python_env(arch)
+
+    if arch == "ice40":
+        iogen_script = fm.get_arch_script(arch, "ice40_create_ioplace.py")
+        ioplace_file = "%s.io.place" % current_project
+        
+        run_helper([
+            "python3",
+            iogen_script,
+            "--blif", eblif,
+            "--net", net,
+            "--map", pin_map
+        ] + pcf_options + [
+            "--out", ioplace_file
+        ], env=python_env)
+
+        return ioplace_file
+    elif arch == "xc7":
+        vpr_grid_map = arch_info.vpr_grid_map
+
+        iogen_script = fm.get_script("prjxray_create_ioplace.py")
+        constraint_gen_script = fm.get_script("prjxray_create_place_constraints.py")
+
+        ioplace_file = "%s.ioplace" % current_project
+
+        run_helper_to(ioplace_file, [
+            "python3",
+            iogen_script,
+            "--blif", eblif,
+            "--net", net,
+            "--map", pin_map
+        ] + pcf_options, env=python_env)
+
+        constraints_file = "%s_constraints.place" % current_project
+        run_helper_to(constraints_file, [
+            "python3",
+            constraint_gen_script,
+            "--blif", eblif,
+            "--net", net,
+            "--vpr_grid_map", vpr_grid_map,
+            "--input", ioplace_file,
+            "--arch", arch_info.definition
+        ], env=python_env)
+
+        return constraints_file
+
+@profiling.staged("place")
+def place_fn(top_module, device, eblif, part, pcf, net, sdc, constraints_file=None):
+    COMMAND_NAME = "place"
+    
+    noisy_warnings_log = "%s_noisy_warnings_%s.log" % (current_project, COMMAND_NAME)
+    stdout_log = "%s_%s.log" % (current_project, COMMAND_NAME)
+    
+    if constraints_file is None:
+        eprint("Generating constraints…")
+        constraints_file = generate_constraints_fn(top_module, device, eblif, part, pcf, net, sdc)
+
+    run_vpr(top_module, arch, device, eblif, sdc, fm, ["--fix_clusters", constraints_file, "--place"], noisy_warnings_log, stdout_log)
+
+# Runs fn, which routes with VPR, retrying with the watchdog's retry profile
+# if need be. VPR being stopped by its watchdog is reported as a flow error.
+def run_watched(fn):
+    try:
+        vpr.with_retry(fn)
+    except RouteAbandoned as e:
+        er.add_error("VPR was stopped: %s." % e.reason).report()
+        exit(65)
+
+@profiling.staged("route")
+def route_fn(top_module, device, eblif, part, pcf, net, sdc):
+    COMMAND_NAME = "route"
+    
+    noisy_warnings_log = "%s_noisy_warnings_%s.log" % (current_project, COMMAND_NAME)
+    stdout_log = "%s_%s.log" % (current_project, COMMAND_NAME)
+    
+    run_watched(lambda: run_vpr(top_module, arch, device, eblif, sdc, fm, ["--route"], noisy_warnings_log, stdout_log))
+
+# Runs consecutive VPR stages (pack, place and route by default) in a single
+# VPR invocation, so the architecture, rr_graph and place delay lookup are
+# only loaded once.
+#
+# When packing is fused with placement, placement constraints depend on the
+# packed netlist: VPR is given a named pipe in place of the constraints file,
+# which only gets generated once VPR opens it at the start of placement.
+def fused_pnr_fn(top_module, device, eblif, part, pcf, net, sdc, stages=["pack", "place", "route"]):
+    COMMAND_NAME = "_".join(stages)
+
+    noisy_warnings_log = "%s_noisy_warnings_%s.log" % (current_project, COMMAND_NAME)
+    stdout_log = "%s_%s.log" % (current_project, COMMAND_NAME)
+
+    net = net or "%s.net" % top_module
+    generate_constraints = lambda: generate_constraints_fn(top_module, device, eblif, part, pcf, net, sdc)
+    stage_args = list(map(lambda x: "--%s" % x, stages))
+
+    fm.get_arch_info(arch, device, part)
+
+    def pnr():
+        if "place" not in stages:
+            run_vpr(top_module, arch, device, eblif, sdc, fm, stage_args, noisy_warnings_log, stdout_log)
+        elif "pack" not in stages:
+            eprint("Generating constraints…")
+            constraints_file = generate_constraints()
+            run_vpr(top_module, arch, device, eblif, sdc, fm, ["--fix_clusters", constraints_file] + stage_args, noisy_warnings_log, stdout_log)
+        else:
+            fifo = ".%s.%i.constraints" % (current_project, os.getpid())
+            with DeferredInput(fifo, generate_constraints) as constraints:
+                try:
+                    run_vpr(top_module, arch, device, eblif, sdc, fm, ["--fix_clusters", fifo] + stage_args, noisy_warnings_log, stdout_log, started=constraints.started)
+                except NonZeroExit:
+                    if constraints.error is not None:
+                        raise constraints.error
+                    raise
+
+    with profiling.stage(COMMAND_NAME):
+        run_watched(pnr)
+
+# Places (and optionally routes) the design once per seed, concurrently, each
+# in its own scratch directory, then promotes the result with the best
+# critical path delay (and wirelength, to break ties) into the project.
+def seed_sweep_fn(top_module, device, eblif, part, pcf, net, sdc, seeds, route=False, timeout=None):
+    import asyncio # Only needed here, and slow to import
+
+    net = net or "%s.net" % top_module
+    place_file = "%s.place" % top_module
+    route_file = "%s.route" % top_module
+
+    eprint("Generating constraints…")
+    constraints_file = generate_constraints_fn(top_module, device, eblif, part, pcf, net, sdc)
+
+    absolute = lambda path: None if path is None else os.path.abspath(path)
+    stages = ["place", "route"] if route else ["place"]
+
+    fm.get_arch_info(arch, device) # Extract before the seeds race to do so
+
+    async def attempt(seed, scratch):
+        common_args = ["--net_file", absolute(net), "--seed", str(seed)]
+        stage_args = {
+            "place": ["--fix_clusters", absolute(constraints_file), "--place"],
+            "route": ["--route"]
+        }
+        for stage in stages:
+            with profiling.stage(stage):
+                await arun_vpr(
+                    top_module, arch, device, absolute(eblif), absolute(sdc), fm,
+                    common_args + stage_args[stage],
+                    "noisy_warnings_%s.log" % stage,
+                    os.path.join(scratch, "%s.log" % stage),
+                    cwd=scratch,
+                    timeout=timeout
+                )
+        return parse_vpr_metrics(os.path.join(scratch, "%s.log" % stages[-1]))
+
+    async def sweep(scratch_dirs):
+        seed_list = sorted(scratch_dirs.keys())
+        outcomes = await asyncio.gather(*[attempt(seed, scratch_dirs[seed]) for seed in seed_list], return_exceptions=True)
+        results = {}
+        for seed, outcome in zip(seed_list, outcomes):
+            if isinstance(outcome, NonZeroExit):
+                eprint("Seed %i failed." % seed)
+            elif isinstance(outcome, BaseException):
+                raise outcome
+            else:
+                results[seed] = outcome
+        return results
+
+    scratch_dirs = {}
+    try:
+        for seed in range(1, seeds + 1):
+            scratch_dirs[seed] = tempfile.mkdtemp(prefix=".silkflow-seed-%i-" % seed, dir=".")
+
+        concurrency = vpr.concurrency
+        vpr.concurrency = concurrency * seeds # The seeds share the CPUs
+        try:
+            results = run_async(sweep(scratch_dirs))
+        finally:
+            vpr.concurrency = concurrency
+        if len(results) == 0:
+            raise NonZeroExit(1)
+
+        def score(seed):
+            metrics = results[seed]
+            return tuple(
+                (metrics[metric] is None, metrics[metric] or 0) for metric in ["critical_path", "wirelength"]
+            )
+        best = min(results.keys(), key=score)
+
+        eprint("%6s %18s %12s" % ("Seed", "Critical Path (ns)", "Wirelength"))
+        for seed in sorted(results.keys()):
+            metrics = results[seed]
+            eprint("%6s %18s %12s" % (
+                ("*%i" if seed == best else "%i") % seed,
+                "-" if metrics["critical_path"] is None else "%.3f" % metrics["critical_path"],
+                "-" if metrics["wirelength"] is None else "%i" % metrics["wirelength"]
+            ))
+
+        scratch = scratch_dirs[best]
+        shutil.copy(os.path.join(scratch, place_file), place_file)
+        if route:
+            shutil.copy(os.path.join(scratch, route_file), route_file)
+        for stage in stages:
+            shutil.copy(os.path.join(scratch, "%s.log" % stage), "%s_%s.log" % (current_project, stage))
+            noisy_warnings_log = os.path.join(scratch, "noisy_warnings_%s.log" % stage)
+            if os.path.exists(noisy_warnings_log):
+                shutil.copy(noisy_warnings_log, "%s_noisy_warnings_%s.log" % (current_project, stage))
+    finally:
+        for scratch in scratch_dirs.values():
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    return best
+
+@profiling.staged("genfasm")
+def write_fasm_fn(top_module, device, eblif, part, pcf, net, sdc, canonicalize=False):
+    COMMAND_NAME = "write_fasm"
+    
+    noisy_warnings_log = "%s_noisy_warnings_%s.log" % (current_project, COMMAND_NAME)
+    stdout_log = "%s_%s.log" % (current_project, COMMAND_NAME)
+    
+    run_genfasm(top_module, arch, device, eblif, fm, [], noisy_warnings_log, stdout_log)
+
+    fasm = "%s.fasm" % top_module
+    fasm_extra = "%s_fasm_extra.fasm" % top_module
+    inputs = [fasm]
+    if os.path.exists(fasm_extra):
+        inputs.append(fasm_extra)
+
+    if canonicalize:
+        eprint("Canonicalizing FASM…")
+        try:
+            with profiling.stage("canonicalize_fasm"):
+                conflicts = canonicalize_fasm(inputs, fasm)
+        except FASMSyntaxError as e:
+            er.add_error("%s." % e, e.file, e.line_no).report()
+            exit(65)
+        if len(conflicts) != 0:
+            for feature, bit, (file, line), (previous_file, previous_line) in conflicts:
+                er.add_error("%s[%i] is both set and cleared (see also %s:%i)." % (feature, bit, previous_file, previous_line), file, line)
+            er.report()
+            exit(65)
+    elif len(inputs) > 1:
+        eprint("Found fasm extra, concatenating with existing result…")
+        append_fasm(fasm, fasm_extra)
+
+    return fasm
+
+@profiling.staged("bitstream")
+def write_bitstream_fn(top_module, device, pxray_device, bit, fasm, part, frm2bit):
+    if arch == "ice40":
+        python_env = fm.get_python_env(arch)
+        asc_file = "%s.asc" % (top_module)
+
+        start = timer()
+        run_helper([
+            "python3",
+            fm.get_arch_script(arch, "fasm_icebox/fasm2asc.py"),
+            "--device", device_base(device),
+            fasm,
+            asc_file
+        ], env=python_env)
+        end = timer()
+        eprint(">> fasm2asc wasted %f seconds. :)" % (end - start))
+        
+        bitstream = r([
+            "icepack",
+            "top.asc"
+        ], pipe_stdout=True, binary=True, env=python_env)
+
+        with open(bit, 'wb') as f:
+            f.write(bitstream)
+    elif arch == "xc7":
+        python_env = fm.get_python_env(arch)
+
+        dbroot = fm.toolchain.prjxray_db()
+        dbroot = os.path.join(dbroot, pxray_device)
+
+        frm2bit_args = []
+        if frm2bit is not None:
+            frm2bit_args.append("--frm2bit"),
+            frm2bit_args.append(frm2bit)
+        
+        r([
+            "xcfasm",
+            "--db-root", dbroot,
+            "--part", part,
+            "--part_file", "%s/%s/part.yaml" % (dbroot, part),
+            "--sparse",
+            "--emit_pudc_b_pullup",
+            "--fn_in", fasm,
+            "--bit_out", bit
+        ] + frm2bit_args, env=python_env)
+        
+@profiling.staged("prefetch")
+def prefetch_fn(device, part, spinner=True, started=None):
+    fm.prefetch(arch, device, part, spinner=spinner, started=started)
+
+# --prefetch: extracts the architecture data of these (device, part) on a
+# daemon thread while the flow goes on. A flow failing or interrupted before
+# result() cancels it, killing pixz, rather than waiting for it on the way
+# out.
+class Prefetch(object):
+    def __init__(self, devices):
+        self.extraction = Extraction()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(devices,), daemon=True)
+        self.thread.start()
+
+    def run(self, devices):
+        try:
+            for device, part in devices:
+                prefetch_fn(device, part, spinner=False, started=self.extraction.started)
+        except BaseException as e:
+            self.error = e
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    # Gives the extraction a moment to clean up its staging directory, but
+    # not to wait on another process's extraction lock
+    def cancel(self):
+        self.extraction.abort()
+        self.thread.join(timeout=5)
+
+@profiling.staged("nextpnr")
+def nextpnr_fn(top_module, device, json, pcf, bit):
+    if arch == "ice40":
+        try: 
+            asc = "%s.asc" % top_module
+
+            [fpga, package] = device.split("-")
+
+
+            r([
+                "nextpnr-ice40",
+                "--%s" % fpga,
+                "--package", package,
+                "--json", json,
+                "--pcf", pcf,
+                "--asc", asc
+            ])
+
+            bitstream = r([
+                "icepack",
+                asc
+            ], pipe_stdout=True, binary=True)
+
+            with open(bit, "wb") as f:
+                f.write(bitstream)
+
+        except ValueError:
+            raise Exception("Unknown device %s." % device)
+    else:
+        raise Exception("Architecture %s unsupported for nextpnr flow." % arch)
+
+# -- Stage Cache --
+def stage_outputs(stage, top_module, bit=None):
+    logs = [
+        "%s_noisy_warnings_%s.log" % (current_project, stage),
+        "%s_%s.log" % (current_project, stage)
+    ]
+    if stage == "synth":
+        return [
+            "%s.raw.json" % top_module,
+            "%s.json" % top_module,
+            "%s.eblif" % top_module,
+            "%s_synth.v" % current_project,
+            "%s_synth.log" % current_project,
+            "%s_fasm_extra.fasm" % top_module,
+            "%s.sdc" % top_module
+        ]
+    elif stage == "pack":
+        return ["%s.net" % top_module] + logs
+    elif stage == "generate_constraints":
+        return [
+            "%s.io.place" % current_project,
+            "%s.ioplace" % current_project,
+            "%s_constraints.place" % current_project
+        ]
+    elif stage == "place":
+        return ["%s.place" % top_module] + stage_outputs("generate_constraints", top_module) + logs
+    elif stage == "route":
+        return ["%s.route" % top_module] + logs
+    elif stage == "write_fasm":
+        return ["%s.fasm" % top_module] + logs
+    elif stage == "write_bitstream":
+        return [bit, "%s.asc" % top_module]
+    raise Exception("Unknown stage %s." % stage)
+
+def synth_key(top_module, device, part, pxray_device, xdc_files, verilog_files):
+    if type(xdc_files) == str:
+        xdc_files = xdc_files.split(":")
+
+    key = StageKey("synth")\
+        .add("arch", arch)\
+        .add("top_module", top_module)\
+        .add("device", device)\
+        .add("part", part)\
+        .add("pxray_device", pxray_device)\
+        .add_files("verilog", verilog_files)\
+        .add_files("xdc", xdc_files)\
+        .add_files("scripts", [
+            fm.get_yosys_script(arch, "synth.tcl"),
+            fm.get_yosys_script(arch, "conv.tcl"),
+            fm.get_script("split_inouts.py")
+        ])\
+        .add_tool("yosys")
+    if arch == "xc7":
+        key.add_tool("prjxray-config")
+    return key
+
+def vpr_stage_key(stage, tool, top_module, device, part, inputs):
+    arch_info = fm.get_arch_info(arch, device)
+
+    key = StageKey(stage)\
+        .add("arch", arch)\
+        .add("top_module", top_module)\
+        .add("device", device)\
+        .add("part", part)\
+        .add("options", get_options(tool, arch, "noisy_warnings.log", threaded=False))\
+        .add_tool(tool)
+    for name, path in arch_info._asdict().items():
+        if type(path) == str:
+            key.add_stat(name, path)
+    for name, path in inputs.items():
+        key.add_file(name, path)
+    if stage in ["generate_constraints", "place"]:
+        key.add_file("pinmap", arch_info.pinmap(for_part=part))
+        key.add_files("scripts", [
+            fm.get_arch_script(arch, "ice40_create_ioplace.py"),
+            fm.get_script("prjxray_create_ioplace.py"),
+            fm.get_script("prjxray_create_place_constraints.py")
+        ])
+    return key
+
+def bitstream_key(top_module, device, pxray_device, fasm, part, frm2bit):
+    key = StageKey("write_bitstream")\
+        .add("arch", arch)\
+        .add("top_module", top_module)\
+        .add("device", device)\
+        .add("part", part)\
+        .add("pxray_device", pxray_device)\
+        .add_file("fasm", fasm)\
+        .add_file("frm2bit", frm2bit)
+    if arch == "ice40":
+        key.add_file("fasm2asc", fm.get_arch_script(arch, "fasm_icebox/fasm2asc.py")).add_tool("icepack")
+    elif arch == "xc7":
+        key.add_tool("xcfasm").add_tool("prjxray-config")
+    return key
+
+# Runs a stage unless a stage with the same inputs has been run before, in
+# which case its outputs are restored from the cache instead.
+def cached_stage(cache, key_fn, outputs, fn, *args):
+    if cache is None:
+        return fn(*args)
+
+    key = key_fn().hexdigest()
+    if cache.restore(key, outputs):
+        eprint("Inputs unchanged, restored outputs from cache.")
+        return
+
+    result = fn(*args)
+    cache.store(key, outputs)
+    return result
+
+# Restores as many of the leading stages as possible from the cache, then runs
+# the rest in one go using fn and caches each of their outputs.
+def cached_stages(cache, stages, key_fns, outputs, fn):
+    pending = list(stages)
+    while cache is not None and len(pending) != 0 and cache.restore(key_fns[pending[0]]().hexdigest(), outputs[pending[0]]):
+        eprint("Inputs to %s unchanged, restored outputs from cache." % pending[0])
+        pending.pop(0)
+
+    if len(pending) == 0:
+        return
+
+    fn(pending)
+    if cache is not None:
+        for stage in pending:
+            cache.store(key_fns[stage]().hexdigest(), outputs[stage])
+
+# -- Commands --
+def use_vpr_profile(name):
+    try:
+        vpr.select_profile(name)
+    except (ValueError, ConfigError) as e:
+        er.add_error(str(e)).report()
+        exit(64)
+    if vpr.profile != "default":
+        eprint("Using VPR profile %s." % vpr.profile)
+
+# For every command running VPR or genfasm
+def vpr_profile_option(fn):
+    @click.option('--vpr-profile', default=None, help="VPR option profile: fast, default, quality or one defined in silkflow.json (default: the vpr.profile set there, or else default)")
+    @functools.wraps(fn)
+    def wrapper(*args, vpr_profile=None, **kwargs):
+        use_vpr_profile(vpr_profile)
+        return fn(*args, **kwargs)
+    return wrapper
+
+def vpr_options(fn):
+    @click.option('-t', '--top-module', required=True, help="Top module")
+    @click.option('-D', '--device', required=True)
+    @click.option('-e', '--eblif', required=True)
+    @click.option('-P', '--part', default=None)
+    @click.option('-p', '--pcf', default=None)
+    @click.option('-n', '--net', default=None)
+    @click.option('-s', '--sdc', default=None)
+    @vpr_profile_option
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        stage = click.get_current_context().info_name
+        implicit = map(lambda x: x % {"top": kwargs["top_module"]}, IMPLICIT_INPUTS[stage])
+        retain_stage(stage, kwargs["top_module"], [kwargs["eblif"], kwargs["net"], kwargs["pcf"], kwargs["sdc"]] + list(implicit))
+        return fn(*args, **kwargs)
+    return wrapper
+
+# Readies the project directory for a single-stage command, after a retention
+# policy compressed the files of a previous run: decompresses the command's
+# inputs and drops the compressed versions of the outputs it replaces
+def retain_stage(stage, top_module, inputs, bit=None):
+    retention.materialize(*inputs)
+    for output in stage_outputs(stage, top_module, bit=bit):
+        retention.discard(output, but=output)
+
+# What the single-stage VPR commands read without being given it
+IMPLICIT_INPUTS = {
+    "pack": [],
+    "generate_constraints": ["%(top)s.net"],
+    "place": ["%(top)s.net"],
+    "route": ["%(top)s.net", "%(top)s.place"],
+    "write_fasm": ["%(top)s.net", "%(top)s.place", "%(top)s.route", "%(top)s_fasm_extra.fasm"]
+}
+
+@click.command('synth', help="Synthesize")
+@click.option('-t', '--top-module', required=True, help="Top module")
+@click.option('-D', '--device', default=None, help="required if xc7")
+@click.option('-P', '--part', default=None, help="required if xc7")
+@click.option('-X', '--pxray-device', default=None, help="xc7 only, required - name of the device according to project xray (i.e. artix7, zynq7…)")
+@click.option('-x', '--xdc-files', default=None, help="xc7 only - XDC files (comma,separated). File paths may not contain spaces.")
+@click.argument('verilog_files', required=True, nargs=-1)
+def synth(top_module, device, part, pxray_device, xdc_files, verilog_files):
+    return synth_fn(top_module, device, pxray_device, part, xdc_files, verilog_files)
+
+@click.command('pack', help="Pack")
+@vpr_options
+def pack(top_module, device, eblif, part, pcf, net, sdc):
+    return pack_fn(top_module, device, eblif, part, pcf, net, sdc)
+
+@click.command('generate_constraints', help="Generate constraints")
+@vpr_options
+def generate_constraints(top_module, device, eblif, part, pcf, net, sdc):
+    return generate_constraints_fn(top_module, device, eblif, part, pcf, net, sdc)
+
+@click.command('place', help="Place")
+@vpr_options
+@click.option('--seeds', default=1, type=int, help="Run this many placements with different seeds concurrently and keep the best result")
+@click.option('--route', 'also_route', is_flag=True, default=False, help="With --seeds, also route each placement and select on post-routing results")
+@click.option('--timeout', default=None, type=int, help="With --seeds, abandon any seed whose VPR invocation runs for longer than this many seconds")
+def place(top_module, device, eblif, part, pcf, net, sdc, seeds, also_route, timeout):
+    if seeds > 1:
+        return seed_sweep_fn(top_module, device, eblif, part, pcf, net, sdc, seeds, route=also_route, timeout=timeout)
+    return place_fn(top_module, device, eblif, part, pcf, net, sdc)
+
+@click.command('route', help="Route")
+@vpr_options
+def route(top_module, device, eblif, part, pcf, net, sdc):
+    return route_fn(top_module, device, eblif, part, pcf, net, sdc)
+
+@click.command('write_fasm', help="Write FASM")
+@vpr_options
+@click.option('--canonicalize', is_flag=True, default=False, help="Deduplicate and sort FASM features, failing on conflicting assignments")
+def write_fasm(top_module, device, eblif, part, pcf, net, sdc, canonicalize):
+    return write_fasm_fn(top_module, device, eblif, part, pcf, net, sdc, canonicalize)
+
+@click.command('write_bitstream', help="Write bitstream")
+@click.option('-t', '--top-module', required=True, help="Top module")
+@click.option('-D', '--device', required=True)
+@click.option('-X', '--pxray-device', default=None, help="xc7 only, required - name of the device according to project xray (i.e. artix7, zynq7…)")
+@click.option('-b', '--bit', required=True)
+@click.option('-f', '--fasm', required=True)
+@click.option('-P', '--part', default=None)
+@click.option('-F', '--frm2bit', default=None, help="xc7 only - frames to bit file")
+def write_bitstream(top_module, device, pxray_device, bit, fasm, part, frm2bit):
+    retain_stage("write_bitstream", top_module, [fasm], bit=bit)
+    return write_bitstream_fn(top_module, device, pxray_device, bit, fasm, part, frm2bit)
+
+@click.command('prefetch', help="Extract a device's architecture data ahead of time")
+@click.option('-D', '--device', required=True)
+@click.option('-P', '--part', default=None, help="Also extract the pinmap for this part")
+def prefetch(device, part):
+    if fm.archive_realpath is None:
+        eprint("This install is not archive-based: everything has been extracted already.")
+        return
+    prefetch_fn(device, part)
+
+@click.command('nextpnr', help="Run nextpnr")
+@click.option('-t', '--top-module', required=True, help="Top module")
+@click.option('-b', '--bit', required=True, help="Name of the bitstream output")
+@click.option('-D', '--device', required=True)
+@click.option('-P', '--part', required=True)
+@click.option('-p', '--pcf', required=True)
+@click.argument('json', required=True, nargs=-1)
+def nextpnr(top_module, bit, device, part, pcf):
+    return nextpnr_fn(top_module, device, json, pcf, bit)
+
+# Everything after synthesis, in the current directory
+def implement_fn(stage_cache, top_module, device, part, pxray_device, pcf, bit, frm2bit, seeds, fused, canonicalize_fasm):
+    history.annotate(device=device, part=part)
+    eblif = "%s.eblif" % top_module
+    net = "%s.net" % top_module
+    place = "%s.place" % top_module
+    route = "%s.route" % top_module
+    fasm = "%s.fasm" % top_module
+
+    fm.get_arch_info(arch, device, part) # Extracts everything the flow needs in one pass
+
+    pnr_keys = {
+        "pack": lambda: vpr_stage_key("pack", "vpr", top_module, device, part, {"eblif": eblif}),
+        "place": lambda: vpr_stage_key("place", "vpr", top_module, device, part, {"eblif": eblif, "net": net, "pcf": pcf}),
+        "route": lambda: vpr_stage_key("route", "vpr", top_module, device, part, {"eblif": eblif, "net": net, "place": place})
+    }
+
+    if fused and seeds == 1:
+        eprint("Packing, placing and routing…")
+        cached_stages(
+            stage_cache,
+            ["pack", "place", "route"],
+            pnr_keys,
+            {stage: stage_outputs(stage, top_module) for stage in pnr_keys.keys()},
+            lambda stages: fused_pnr_fn(top_module, device, eblif, part, pcf, net, None, stages=stages)
+        )
+    else:
+        eprint("Packing…")
+        cached_stage(
+            stage_cache,
+            pnr_keys["pack"],
+            stage_outputs("pack", top_module),
+            pack_fn, top_module, device, eblif, part, pcf, None, None
+        )
+
+    if seeds > 1:
+        eprint("Placing and routing with %i seeds…" % seeds)
+        cached_stage(
+            stage_cache,
+            lambda: pnr_keys["place"]().add("seeds", seeds),
+            stage_outputs("place", top_module) + stage_outputs("route", top_module),
+            seed_sweep_fn, top_module, device, eblif, part, pcf, net, None, seeds, True
+        )
+    elif not fused:
+        eprint("Placing…")
+        cached_stage(
+            stage_cache,
+            pnr_keys["place"],
+            stage_outputs("place", top_module),
+            place_fn, top_module, device, eblif, part, pcf, net, None
+        )
+
+        eprint("Routing…")
+        cached_stage(
+            stage_cache,
+            pnr_keys["route"],
+            stage_outputs("route", top_module),
+            route_fn, top_module, device, eblif, part, pcf, net, None
+        )
+
+    eprint("Writing FASM…")
+    cached_stage(
+        stage_cache,
+        lambda: vpr_stage_key("write_fasm", "genfasm", top_module, device, part, {
+            "eblif": eblif,
+            "net": net,
+            "place": place,
+            "route": route,
+            "fasm_extra": "%s_fasm_extra.fasm" % top_module
+        }).add("canonicalize", canonicalize_fasm),
+        stage_outputs("write_fasm", top_module),
+        write_fasm_fn, top_module, device, eblif, part, pcf, net, None, canonicalize_fasm
+    )
+
+    eprint("Writing bitstream…")
+    cached_stage(
+        stage_cache,
+        lambda: bitstream_key(top_module, device, pxray_device, fasm, part, frm2bit),
+        stage_outputs("write_bitstream", top_module, bit=bit),
+        write_bitstream_fn, top_module, device, pxray_device, bit, fasm, part, frm2bit
+    )
+
+# --targets device:part[:pxray_device],…
+def parse_targets(targets, pxray_device):
+    parsed = []
+    for target in targets.split(","):
+        fields = target.strip().split(":")
+        if len(fields) not in [2, 3] or "" in fields:
+            raise click.BadParameter("'%s' is not of the form device:part[:pxray_device]." % target, param_hint="--targets")
+        parsed.append(d2nt({
+            "name": ":".join(fields[:2]),
+            "device": fields[0],
+            "part": fields[1],
+            "pxray_device": fields[2] if len(fields) == 3 else pxray_device,
+            "directory": os.path.join("targets", "%s_%s" % (fields[0], fields[1]))
+        }))
+    return parsed
+
+# Targets with the same synthesis group share a synthesis: on ice40 it doesn't
+# depend on the device at all, on xc7 it depends on the part (its part.json).
+def synthesis_group(target):
+    if arch == "ice40":
+        return None
+    return (target.part, target.pxray_device)
+
+# Synthesizes once per synthesis group, in the project directory, then
+# implements every target in parallel in targets/<device>_<part>/, at most
+# jobs at a time. A target failing doesn't stop the others.
+def run_targets_fn(stage_cache, targets, jobs, top_module, pcf, bit, xdc_files, verilog_files, frm2bit, seeds, fused, canonicalize_fasm, prefetch):
+    pcf = os.path.abspath(pcf) if pcf is not None else None
+    frm2bit = os.path.abspath(frm2bit) if frm2bit is not None else None
+
+    groups = {}
+    for target in targets:
+        groups.setdefault(synthesis_group(target), []).append(target)
+
+    prefetching = None
+    if prefetch:
+        prefetching = Prefetch(list(map(lambda x: (x.device, x.part), targets)))
+
+    failed = []
+    def on_exit(name, status, wall):
+        if status == 0:
+            eprint("%s: bitstream generated in %fs." % (name, wall))
+        else:
+            eprint("%s: failed (%i), see %s." % (name, status, os.path.join(directories[name], "silkflow.log")))
+            failed.append(name)
+
+    directories = {target.name: target.directory for target in targets}
+    jobs = jobs or len(os.sched_getaffinity(0))
+    vpr.concurrency = min(jobs, len(targets)) # Children share the CPUs
+    fanout = Fanout(jobs)
+    try:
+        for group_targets in groups.values():
+            first = group_targets[0]
+            eprint("Synthesizing for %s…" % ", ".join(map(lambda x: x.name, group_targets)))
+            try:
+                cached_stage(
+                    stage_cache,
+                    lambda: synth_key(top_module, first.device, first.part, first.pxray_device, xdc_files, verilog_files),
+                    stage_outputs("synth", top_module),
+                    synth_fn, top_module, first.device, first.part, first.pxray_device, xdc_files, verilog_files
+                )
+            except (SystemExit, NonZeroExit):
+                failed += map(lambda x: x.name, group_targets)
+                continue
+
+            for target in group_targets:
+                mkdirp(target.directory)
+                for output in stage_outputs("synth", top_module):
+                    if os.path.exists(output):
+                        shutil.copy2(output, os.path.join(target.directory, output))
+
+            if prefetching is not None: # Not forking with extraction under way
+                prefetching.result()
+                prefetching = None
+
+            for target in group_targets:
+                eprint("Implementing %s in %s…" % (target.name, target.directory))
+                fanout.submit(
+                    target.name,
+                    target.directory,
+                    "silkflow.log",
+                    functools.partial(implement_fn, stage_cache, top_module, target.device, target.part, target.pxray_device, pcf, bit, frm2bit, seeds, fused, canonicalize_fasm),
+                    on_exit
+                )
+    finally:
+        if prefetching is not None:
+            prefetching.cancel()
+    fanout.wait()
+
+    if len(failed) != 0:
+        er.add_error("%i of %i targets failed: %s." % (len(failed), len(targets), ", ".join(failed))).report()
+        exit(65)
+
+@click.command('run', help="Full flow")
+@click.option('-t', '--top-module', required=True, help="Top module")
+@click.option('-b', '--bit', required=True, help="Name of the bitstream output")
+@click.option('-D', '--device', default=None, help="Required unless --targets is given")
+@click.option('-P', '--part', default=None, help="Required unless --targets is given")
+@click.option('-X', '--pxray-device', default=None, help="xc7 only, required - name of the device according to project xray (i.e. artix7, zynq7…)")
+@click.option('-p', '--pcf', default=None, help = "Pin constraints file. One of -p or -x are required.")
+@click.option('-x', '--xdc-files', default=None, help="xc7 only - XDC files (comma,separated). File paths may not contain spaces. One of -p or -x are required.")
+@click.option('-F', '--frm2bit', default=None, help="xc7 only - frames to bit file")
+@click.option('--cache/--no-cache', default=True, help="Skip stages whose inputs have not changed since a previous run, restoring their outputs from the stage cache. The cache is shared between projects: see SILKFLOW_CACHE_DIR and SILKFLOW_CACHE_SIZE.")
+@click.option('--seeds', default=1, type=int, help="Place and route with this many seeds concurrently and keep the best result")
+@click.option('--fused/--staged', default=True, help="Pack, place and route in a single VPR invocation (the default) or with one VPR invocation per stage")
+@click.option('--canonicalize-fasm', is_flag=True, default=False, help="Deduplicate and sort FASM features, failing on conflicting assignments")
+@click.option('--prefetch', is_flag=True, default=False, help="Extract the device's architecture data in the background during synthesis (archive-based installs only)")
+@click.option('--targets', default=None, help="Build for several devices instead of -D/-P (device:part[:pxray_device],…): synthesizes once, then implements every target in parallel in targets/<device>_<part>/")
+@click.option('-j', '--jobs', default=None, type=click.IntRange(min=1), help="With --targets, maximum number of targets to implement concurrently (default: number of CPUs)")
+@click.option('--scratch', default=None, help="Run in a private workspace created in this directory (\"shm\" for /dev/shm, default: the project directory), so that flows sharing a project directory don't clobber each other, then move the flow's outputs back into the project directory. \"off\" runs in the project directory itself. See SILKFLOW_SCRATCH.")
+@click.option('--retention', 'retention_policy', default=None, type=click.Choice(sorted(retention.POLICIES.keys())), help="What to do with the intermediate files and logs once the flow is done: keep them, compress them, or only keep the bitstream and (compressed) logs: final. Default: the retention policy set in silkflow.json, or else keep. See SILKFLOW_RETENTION.")
+@click.argument('verilog_files', required=True, nargs=-1)
+@vpr_profile_option
+def run(top_module, device, part, pxray_device, pcf, bit, xdc_files, verilog_files, frm2bit, cache, seeds, fused, canonicalize_fasm, prefetch, targets, jobs, scratch, retention_policy):
+    if targets is not None:
+        if device is not None or part is not None:
+            raise click.UsageError("-D/--device and -P/--part can't be used with --targets.")
+        if os.path.isabs(bit) or os.path.normpath(bit).split(os.sep)[0] == os.pardir: # Every target would write the same file
+            raise click.UsageError("With --targets, -b/--bit names each target's bitstream in its own directory: %s is outside of it." % bit)
+        targets = parse_targets(targets, pxray_device)
+    elif device is None or part is None:
+        raise click.UsageError("Missing option -D/--device or -P/--part (or --targets).")
+
+    start = timer()
+    eprint("Starting flow…")
+    helpers.enabled = True
+
+    eprint("\n---\n")
+
+    stage_cache = StageCache() if cache else None
+
+    bit = os.path.normpath(bit)
+    if targets is None and bit.split(os.sep)[0] == os.pardir: # Outside the project directory, so written there in place
+        bit = os.path.abspath(bit)
+    bits = [bit] if targets is None else list(map(lambda x: os.path.join(x.directory, bit), targets))
+    try:
+        policy = retention.load(retention_policy, finals=list(map(os.path.normpath, bits)))
+    except ConfigError as e:
+        er.add_error(str(e)).report()
+        exit(64)
+
+    absolute = lambda path: None if path is None else os.path.abspath(path)
+    verilog_files = list(map(absolute, verilog_files))
+    if xdc_files is not None:
+        xdc_files = ":".join(map(absolute, xdc_files.split(":")))
+    with Workspace(scratch_root(scratch), run_outputs(top_module, bit, targets), policy=policy):
+        if os.path.dirname(bit) != "":
+            mkdirp(os.path.dirname(bit))
+        run_fn(stage_cache, targets, jobs, top_module, device, part, pxray_device, absolute(pcf), bit, xdc_files, verilog_files, absolute(frm2bit), seeds, fused, canonicalize_fasm, prefetch)
+
+    end = timer()
+    if targets is not None:
+        eprint("%i bitstreams generated in %fs." % (len(targets), end - start))
+    else:
+        eprint("Bitstream generated in %fs." % (end - start))
+    er.report()
+
+# What run leaves in the project directory, the bitstreams last
+def run_outputs(top_module, bit, targets=None):
+    outputs = []
+    for stage in ["synth", "pack", "place", "route", "write_fasm"]:
+        outputs += stage_outputs(stage, top_module)
+    outputs += ["%s_*.log" % glob.escape(current_project), "vpr_stdout.log", "%s.asc" % top_module] # vpr_stdout.log: left by a failed VPR
+    outputs += ["*.rpt", "%s.net.post_routing" % glob.escape(top_module)] # VPR's timing and utilization reports
+    if targets is None:
+        return outputs + [bit]
+    per_target = []
+    for target in targets:
+        per_target += map(lambda x: os.path.join(target.directory, x), outputs + ["silkflow.log"])
+    return outputs + per_target + list(map(lambda x: os.path.join(x.directory, bit), targets))
+
+def run_fn(stage_cache, targets, jobs, top_module, device, part, pxray_device, pcf, bit, xdc_files, verilog_files, frm2bit, seeds, fused, canonicalize_fasm, prefetch):
+    if targets is not None:
+        run_targets_fn(stage_cache, targets, jobs, top_module, pcf, bit, xdc_files, verilog_files, frm2bit, seeds, fused, canonicalize_fasm, prefetch)
+        return
+
+    prefetching = None
+    if prefetch:
+        prefetching = Prefetch([(device, part)])
+
+    try:
+        eprint("Synthesizing…")
+        cached_stage(
+            stage_cache,
+            lambda: synth_key(top_module, device, part, pxray_device, xdc_files, verilog_files),
+            stage_outputs("synth", top_module),
+            synth_fn, top_module, device, part, pxray_device, xdc_files, verilog_files
+        )
+        if prefetching is not None:
+            prefetching.result()
+            prefetching = None
+    finally:
+        if prefetching is not None:
+            prefetching.cancel()
+    implement_fn(stage_cache, top_module, device, part, pxray_device, pcf, bit, frm2bit, seeds, fused, canonicalize_fasm)
+
+@click.command('build', help="Incremental full flow: only reruns the stages whose inputs have changed since the last build")
+@click.option('-t', '--top-module', required=True, help="Top module")
+@click.option('-b', '--bit', required=True, help="Name of the bitstream output")
+@click.option('-D', '--device', required=True)
+@click.option('-P', '--part', required=True)
+@click.option('-X', '--pxray-device', default=None, help="xc7 only, required - name of the device according to project xray (i.e. artix7, zynq7…)")
+@click.option('-p', '--pcf', default=None, help = "Pin constraints file. One of -p or -x are required.")
+@click.option('-x', '--xdc-files', default=None, help="xc7 only - XDC files (comma,separated). File paths may not contain spaces. One of -p or -x are required.")
+@click.option('-F', '--frm2bit', default=None, help="xc7 only - frames to bit file")
+@click.option('-j', '--jobs', default=None, type=click.IntRange(min=1), help="Maximum number of stages to run concurrently (default: number of CPUs)")
+@click.option('--cache/--no-cache', default=True, help="Restore out-of-date stages from the shared stage cache where possible")
+@click.option('--canonicalize-fasm', is_flag=True, default=False, help="Deduplicate and sort FASM features, failing on conflicting assignments")
+@click.argument('verilog_files', required=True, nargs=-1)
+@vpr_profile_option
+def build(top_module, device, part, pxray_device, pcf, bit, xdc_files, verilog_files, frm2bit, jobs, cache, canonicalize_fasm):
+    from .build import BuildGraph, Node # Pulls in concurrent.futures, which no other command needs
+
+    start = timer()
+    helpers.enabled = True
+
+    stage_cache = StageCache() if cache else None
+
+    xdc_list = xdc_files.split(":") if xdc_files is not None else []
+    eblif = "%s.eblif" % top_module
+    net = "%s.net" % top_module
+    place = "%s.place" % top_module
+    route = "%s.route" % top_module
+    fasm = "%s.fasm" % top_module
+    fasm_extra = "%s_fasm_extra.fasm" % top_module if arch == "xc7" else None
+    constraints = "%s.io.place" % current_project if arch == "ice40" else "%s_constraints.place" % current_project
+
+    graph = BuildGraph()
+    def add_node(name, inputs, outputs, key_fn, fn, *args):
+        graph.add(Node(name, inputs, outputs, key_fn, lambda: cached_stage(stage_cache, key_fn, outputs, fn, *args)))
+
+    add_node(
+        "synth",
+        list(verilog_files) + xdc_list,
+        stage_outputs("synth", top_module),
+        lambda: synth_key(top_module, device, part, pxray_device, xdc_files, verilog_files),
+        synth_fn, top_module, device, part, pxray_device, xdc_files, verilog_files
+    )
+    add_node(
+        "pack",
+        [eblif],
+        stage_outputs("pack", top_module),
+        lambda: vpr_stage_key("pack", "vpr", top_module, device, part, {"eblif": eblif}),
+        pack_fn, top_module, device, eblif, part, pcf, net, None
+    )
+    add_node(
+        "generate_constraints",
+        [eblif, net, pcf],
+        stage_outputs("generate_constraints", top_module),
+        lambda: vpr_stage_key("generate_constraints", "vpr", top_module, device, part, {"eblif": eblif, "net": net, "pcf": pcf}),
+        generate_constraints_fn, top_module, device, eblif, part, pcf, net, None
+    )
+    add_node(
+        "place",
+        [eblif, net, constraints],
+        [output for output in stage_outputs("place", top_module) if output not in stage_outputs("generate_constraints", top_module)],
+        lambda: vpr_stage_key("place", "vpr", top_module, device, part, {"eblif": eblif, "net": net, "constraints": constraints}),
+        place_fn, top_module, device, eblif, part, pcf, net, None, constraints
+    )
+    add_node(
+        "route",
+        [eblif, net, place],
+        stage_outputs("route", top_module),
+        lambda: vpr_stage_key("route", "vpr", top_module, device, part, {"eblif": eblif, "net": net, "place": place}),
+        route_fn, top_module, device, eblif, part, pcf, net, None
+    )
+    add_node(
+        "write_fasm",
+        [eblif, net, place, route, fasm_extra],
+        stage_outputs("write_fasm", top_module),
+        lambda: vpr_stage_key("write_fasm", "genfasm", top_module, device, part, {
+            "eblif": eblif,
+            "net": net,
+            "place": place,
+            "route": route,
+            "fasm_extra": fasm_extra
+        }).add("canonicalize", canonicalize_fasm),
+        write_fasm_fn, top_module, device, eblif, part, pcf, net, None, canonicalize_fasm
+    )
+    add_node(
+        "write_bitstream",
+        [fasm, frm2bit],
+        stage_outputs("write_bitstream", top_module, bit=bit),
+        lambda: bitstream_key(top_module, device, pxray_device, fasm, part, frm2bit),
+        write_bitstream_fn, top_module, device, pxray_device, bit, fasm, part, frm2bit
+    )
+
+    # Up to date outputs a retention policy compressed are still up to date
+    for node in graph.nodes:
+        retention.materialize(*node.inputs, *node.outputs)
+
+    rebuilt = graph.build(jobs)
+
+    end = timer()
+    if len(rebuilt) == 0:
+        eprint("Everything is up to date.")
+    else:
+        eprint("Rebuilt %s in %fs." % (", ".join(rebuilt), end - start))
+    er.report()
+
+@click.command('run_nextpnr', help="Run full flow (nextpnr variant)")
+@click.option('-t', '--top-module', required=True, help="Top module")
+@click.option('-b', '--bit', required=True, help="Name of the bitstream output")
+@click.option('-D', '--device', required=True)
+@click.option('-P', '--part', required=True)
+@click.option('-p', '--pcf', required=True)
+@click.argument('verilog_files', required=True, nargs=-1)
+def run_nextpnr(top_module, bit, device, part, pcf, verilog_files):
+    start = timer()
+    eprint("Starting flow…")
+
+    eprint("\n---\n")
+
+    eprint("Synthesizing…")
+
+    synth_out = synth_fn(top_module, device, part, None, None, verilog_files)
+
+    eprint("Generating bitstream…")
+    nextpnr_fn(top_module, device, synth_out.json, pcf, bit)
+    
+    end = timer()
+    eprint("Bitstream generated in %fs." % (end-start))
+    er.report()
@@ -0,0 +1,149 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The server side of helpers.HelperPool. It runs under the toolchain's python3,
+# not silkflow's interpreter, and must not import anything from silkflow:
+#
+#   python3 helper_server.py <socket> <owner fd> [module to preload…]
+#
+# Once listening it prints "ready", then imports the modules to preload. Every
+# connection is a request to run a script: the server forks a handler, which
+# forks the script off with the client's stdio, cwd and environment, runs it
+# with runpy and reports back its pid, then its exit status and resource usage.
+#
+# The server exits once the owner fd, the read end of a pipe only its owner
+# holds the other end of, reaches EOF: i.e. as soon as silkflow exits, however
+# it exits.
+import sys
+del sys.path[0] # This directory: silkflow's modules would shadow the toolchain's (fasm…)
+
+import os
+import json
+import array
+import runpy
+import select
+import signal
+import socket
+import importlib
+import traceback
+
+def receive(connection):
+    fds = array.array("i")
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk, ancdata, _, _ = connection.recvmsg(64 * 1024, socket.CMSG_LEN(3 * fds.itemsize))
+        if len(chunk) == 0:
+            raise EOFError()
+        data += chunk
+        for level, kind, payload in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(payload[:len(payload) - (len(payload) % fds.itemsize)])
+    return json.loads(data.decode("utf-8")), list(fds)
+
+def send(connection, message):
+    connection.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+# Runs in the script's process. Never returns.
+def run_script(request, fds):
+    status = 1
+    try:
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+
+        script = request["argv"][0]
+        sys.argv = list(request["argv"])
+        sys.path.insert(0, os.path.dirname(os.path.abspath(script))) # As python3 script.py would
+        try:
+            runpy.run_path(script, run_name="__main__")
+            status = 0
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                sys.stderr.write("%s\n" % e.code)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status & 255)
+
+def handle(connection):
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    request, fds = receive(connection)
+    pid = os.fork()
+    if pid == 0:
+        connection.close()
+        run_script(request, fds)
+    for fd in fds:
+        os.close(fd)
+    send(connection, {"pid": pid})
+    _, status, rusage = os.wait4(pid, 0)
+    send(connection, {
+        "status": -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status),
+        "user": rusage.ru_utime,
+        "sys": rusage.ru_stime,
+        "max_rss_kib": rusage.ru_maxrss
+    })
+
+def main():
+    socket_path = sys.argv[1]
+    owner = int(sys.argv[2])
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(64)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN) # Handlers reap themselves
+    sys.stdout.write("ready\n")
+    sys.stdout.flush()
+
+    for module in sys.argv[3:]:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            pass # Whatever scripts need that isn't there will fail in the script
+
+    try:
+        while True:
+            readable, _, _ = select.select([listener, owner], [], [])
+            if owner in readable:
+                return
+            connection, _ = listener.accept()
+            if os.fork() == 0:
+                try:
+                    listener.close()
+                    os.close(owner)
+                    handle(connection)
+                finally:
+                    os._exit(0)
+            connection.close()
+    finally:
+        os.unlink(socket_path)
+        try:
+            os.rmdir(os.path.dirname(socket_path))
+        except OSError:
+            pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from .util import r, eprint, NonZeroExit
+from . import profiling
+
+import os
+import json
+import time
+import array
+import signal
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+from collections import namedtuple
+
+server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "helper_server.py")
+
+# Imported once by the pool rather than by every helper script
+preloads = {
+    "ice40": ["fasm", "icebox"],
+    "xc7": ["fasm", "lxml.etree", "prjxray.db"]
+}
+
+Rusage = namedtuple("Rusage", ["ru_utime", "ru_stime", "ru_maxrss"])
+
+# A forkserver for the Symbiflow helper scripts (split_inouts.py, the ioplace
+# and constraint generators, fasm2asc.py…), which otherwise each start a fresh
+# python3 and import the same heavy modules over again.
+#
+# The server (helper_server.py) runs under the toolchain's python3 with the
+# helpers' PYTHONPATH, preloads their dependencies while the flow does other
+# things, then forks a worker per script. Workers get the caller's stdio, cwd
+# and environment, so running a script through the pool is indistinguishable
+# from running it directly.
+class HelperPool(object):
+    def __init__(self, env, preload=[]):
+        self.socket_path = os.path.join(tempfile.mkdtemp(prefix="silkflow-helpers-"), "socket")
+        owner, self.owner = os.pipe() # See helper_server.py
+        try:
+            self.process = subprocess.Popen(["python3", server_script, self.socket_path, str(owner)] + preload, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, pass_fds=[owner])
+        finally:
+            os.close(owner)
+        self.ready = False
+
+    # Started without waiting, so the interpreter starts while the caller does
+    # something else
+    def wait_ready(self):
+        if not self.ready:
+            if self.process.stdout.readline() != b"ready\n":
+                shutil.rmtree(os.path.dirname(self.socket_path), ignore_errors=True)
+                raise Exception("The helper pool failed to start.")
+            self.ready = True
+
+    # Like r(cmd, stdout=stdout, env=env) for cmd = ["python3", script, …]
+    def run(self, cmd, env, stdout=None):
+        start = time.time()
+        request = json.dumps({
+            "argv": cmd[1:],
+            "cwd": os.getcwd(),
+            "env": dict(env or os.environ)
+        }).encode("utf-8") + b"\n"
+        fds = array.array("i", [0, stdout.fileno() if stdout is not None else 1, 2])
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(self.socket_path)
+            sent = client.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+            client.sendall(request[sent:])
+            with client.makefile("rb") as replies:
+                pid = json.loads(replies.readline())["pid"]
+                try:
+                    reply = replies.readline()
+                except BaseException:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    raise
+        if len(reply) == 0:
+            raise Exception("The helper pool stopped while running %s." % " ".join(cmd))
+        result = json.loads(reply)
+
+        status = result["status"]
+        profiling.record(cmd, start, time.time() - start, Rusage(result["user"], result["sys"], result["max_rss_kib"]), status)
+        if status != 0:
+            eprint(("Command had a non-zero exit (%i): " % (status & 255)) + " ".join(cmd))
+            raise NonZeroExit(status)
+
+# One pool per architecture, started on first use. None if it could not be:
+# helpers then run as plain subprocesses.
+#
+# A pool only pays for itself across several helpers, so only commands that
+# run several (run, build, serve) enable pools; the others run their one
+# helper directly. SILKFLOW_HELPER_POOL=off disables pools altogether.
+enabled = False
+pools = {}
+pools_lock = threading.Lock()
+def get_pool(arch, get_env):
+    with pools_lock:
+        if arch not in pools:
+            if not enabled:
+                return None
+            pools[arch] = None
+            if (os.getenv("SILKFLOW_HELPER_POOL") or "").lower() not in ["off", "0", "none"]:
+                try:
+                    pools[arch] = HelperPool(get_env(), preloads.get(arch) or [])
+                except Exception as e:
+                    eprint("Could not start the helper pool, running helpers directly: %s" % e)
+        return pools[arch]
+
+def get_ready_pool(arch, get_env):
+    pool = get_pool(arch, get_env)
+    if pool is not None:
+        try:
+            with pools_lock:
+                pool.wait_ready()
+        except Exception as e:
+            eprint("%s Running helpers directly." % e)
+            pool = pools[arch] = None
+    return pool
+
+# Runs cmd = ["python3", script, …] through the arch's pool if possible.
+# stdout, if given, is a file the script's standard output goes straight to.
+def run_helper(arch, get_env, cmd, env=None, stdout=None):
+    pool = get_ready_pool(arch, get_env)
+    if pool is None:
+        r(cmd, env=env, stdout=stdout)
+        return
+    pool.run(cmd, env, stdout=stdout)
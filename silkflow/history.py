@@ -0,0 +1,306 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run history: every stage execution, recorded in a local SQLite database, and
+# the stats command querying it.
+#
+# The database is at SILKFLOW_HISTORY, by default history.sqlite3 in the cache
+# directory. SILKFLOW_HISTORY=off disables recording.
+#
+# Every stage is committed as soon as it finishes, in its own transaction:
+# multi-target children and serve workers leave with os._exit, and several of
+# them can be writing at once.
+from .__init__ import __version__
+from .util import cache_dir, hash_file
+from .error import eprint
+from . import profiling
+
+import click
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    version TEXT,
+    command TEXT,
+    stage TEXT NOT NULL,
+    arch TEXT,
+    device TEXT,
+    part TEXT,
+    top_module TEXT,
+    design TEXT,
+    options TEXT,
+    project TEXT,
+    wall REAL,
+    cpu REAL,
+    max_rss_kib INTEGER,
+    processes INTEGER,
+    status INTEGER,
+    output_bytes INTEGER,
+    outputs TEXT
+);
+CREATE INDEX IF NOT EXISTS stages_by_device ON stages (stage, device);
+"""
+
+# Parameters naming the design a command was run on, in order of preference
+DESIGN_PARAMS = ["verilog_files", "eblif", "json", "fasm"]
+
+def database_path():
+    path = os.getenv("SILKFLOW_HISTORY")
+    if (path or "").lower() in ["off", "0", "none"]:
+        return None
+    return path or cache_dir("history.sqlite3")
+
+def connect(path):
+    import sqlite3 # Only needed once a stage has run
+    directory = os.path.dirname(path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30)
+    connection.executescript(SCHEMA)
+    return connection
+
+# A digest of the design's input files, so the same design is recognized
+# across projects and renames
+def design_hash(params):
+    for name in DESIGN_PARAMS:
+        files = params.get(name)
+        if files is None:
+            continue
+        if isinstance(files, str):
+            files = [files]
+        digest = hashlib.sha256()
+        try:
+            for path in sorted(files):
+                digest.update(hash_file(path).encode("utf-8"))
+        except OSError:
+            return None
+        return digest.hexdigest()
+    return None
+
+# What the command being run is: taken from the click context of the thread
+# running it, and kept for stages finishing on other threads (prefetch…)
+context = None
+context_key = None
+context_lock = threading.Lock()
+def get_context():
+    global context, context_key
+    ctx = click.get_current_context(silent=True)
+    with context_lock:
+        if ctx is not None and ctx is not context_key:
+            params = dict(ctx.params)
+            context_key = ctx
+            context = {
+                "command": ctx.info_name,
+                "arch": os.getenv("SYMBIFLOW_ARCH") or "ice40",
+                "device": params.get("device"),
+                "part": params.get("part"),
+                "top_module": params.get("top_module"),
+                "design": design_hash(params),
+                "options": json.dumps(params, sort_keys=True, default=str)
+            }
+        return context
+
+# Overrides parts of the context for the rest of this process, e.g. the
+# device of a multi-target run's child
+def annotate(**fields):
+    get_context()
+    with context_lock:
+        if context is not None:
+            context.update(fields)
+
+# Top-level files in the working directory written since start
+def outputs_since(start):
+    outputs = {}
+    try:
+        names = os.listdir(".")
+    except OSError:
+        return outputs
+    for name in names:
+        try:
+            stat = os.stat(name)
+        except OSError:
+            continue
+        if os.path.isfile(name) and stat.st_mtime >= start:
+            outputs[name] = stat.st_size
+    return outputs
+
+def record(entry, records):
+    path = database_path()
+    if path is None:
+        return
+    current = get_context() or {}
+    start = profiling.origin + entry["start"]
+    outputs = outputs_since(start)
+    row = {
+        "time": start,
+        "version": __version__,
+        "command": current.get("command"),
+        "stage": entry["stage"],
+        "arch": current.get("arch") or os.getenv("SYMBIFLOW_ARCH") or "ice40",
+        "device": current.get("device"),
+        "part": current.get("part"),
+        "top_module": current.get("top_module"),
+        "design": current.get("design"),
+        "options": current.get("options"),
+        "project": current.get("project") or os.getcwd(),
+        "wall": entry["wall"],
+        "cpu": sum(map(lambda x: (x["user"] or 0.0) + (x["sys"] or 0.0), records)),
+        "max_rss_kib": max([x["max_rss_kib"] or 0 for x in records] + [0]),
+        "processes": len(records),
+        "status": entry["status"],
+        "output_bytes": sum(outputs.values()),
+        "outputs": json.dumps(outputs, sort_keys=True)
+    }
+    try:
+        connection = connect(path)
+        try:
+            with connection:
+                connection.execute("INSERT INTO stages (%s) VALUES (%s)" % (", ".join(row.keys()), ", ".join(["?"] * len(row))), list(row.values()))
+        finally:
+            connection.close()
+    except Exception as e:
+        eprint("Could not record %s in the run history: %s" % (entry["stage"], e))
+
+# The highest peak RSS (KiB) of the last successful runs of these stages on
+# this device, or None if there are none. Runs with no RSS sampled (recorded
+# as 0, e.g. by seed sweeps) are not counted.
+def peak_rss(device, stages, runs=20):
+    path = database_path()
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        connection = connect(path)
+        try:
+            rows = connection.execute(
+                "SELECT max_rss_kib FROM stages WHERE device = ? AND stage IN (%s) AND status = 0 AND processes > 0 AND max_rss_kib > 0 ORDER BY time DESC LIMIT ?" % ", ".join(["?"] * len(stages)),
+                [device] + list(stages) + [runs]
+            ).fetchall()
+        finally:
+            connection.close()
+    except Exception:
+        return None
+    return max(map(lambda x: x[0], rows)) if len(rows) != 0 else None
+
+def enable():
+    if record not in profiling.listeners:
+        profiling.listeners.append(record)
+
+# Linear interpolation between closest ranks
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+def seconds(value):
+    return "%.2f" % value if value is not None else "-"
+
+GROUPINGS = {
+    "device": lambda x: "%s (%s)" % (x["device"], x["part"]) if x["part"] else str(x["device"]),
+    "part": lambda x: str(x["part"]),
+    "design": lambda x: "%s %s" % ((x["design"] or "-")[:12], x["top_module"] or ""),
+    "version": lambda x: str(x["version"]),
+    "stage": lambda x: "-",
+    "command": lambda x: str(x["command"])
+}
+
+@click.command('stats', help="Summarize the run history: stage times by device, design or silkflow version")
+@click.option('--by', 'grouping', type=click.Choice(sorted(GROUPINGS.keys())), default="device", help="What to group stage executions by, in addition to the stage")
+@click.option('--stage', default=None, help="Only this stage (route, synth…)")
+@click.option('-D', '--device', default=None, help="Only this device")
+@click.option('--design', default=None, help="Only designs whose hash starts with this")
+@click.option('--since', default=None, type=float, help="Only the last this many days")
+@click.option('--failed/--all', default=False, help="Only failed stage executions")
+@click.option('--slowest', default=None, type=int, help="List this many of the slowest stage executions instead")
+def stats(grouping, stage, device, design, since, failed, slowest):
+    path = database_path()
+    if path is None or not os.path.exists(path):
+        eprint("No runs recorded yet.")
+        return
+
+    conditions = []
+    parameters = []
+    if stage is not None:
+        conditions.append("stage = ?")
+        parameters.append(stage)
+    if device is not None:
+        conditions.append("device = ?")
+        parameters.append(device)
+    if design is not None:
+        conditions.append("design LIKE ?")
+        parameters.append(design + "%")
+    if since is not None:
+        conditions.append("time >= ?")
+        parameters.append(time.time() - since * 86400)
+    if failed:
+        conditions.append("status != 0")
+    where = "WHERE %s" % " AND ".join(conditions) if len(conditions) != 0 else ""
+
+    connection = connect(path)
+    try:
+        cursor = connection.execute("SELECT * FROM stages %s ORDER BY time" % where, parameters)
+        columns = list(map(lambda x: x[0], cursor.description))
+        rows = [dict(zip(columns, row)) for row in cursor]
+    finally:
+        connection.close()
+
+    if len(rows) == 0:
+        eprint("No matching runs.")
+        return
+
+    if slowest is not None:
+        rows = sorted(rows, key=lambda x: x["wall"], reverse=True)[:slowest]
+        print("%-19s %-24s %-24s %-24s %10s %10s %14s %6s" % ("Time", "Stage", "Device", "Design", "Wall (s)", "CPU (s)", "Peak RSS (MiB)", "Status"))
+        for row in rows:
+            print("%-19s %-24s %-24s %-24s %10s %10s %14.1f %6i" % (
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["time"])),
+                row["stage"],
+                GROUPINGS["device"](row),
+                GROUPINGS["design"](row),
+                seconds(row["wall"]),
+                seconds(row["cpu"]),
+                (row["max_rss_kib"] or 0) / 1024,
+                row["status"]
+            ))
+        return
+
+    groups = {}
+    for row in rows:
+        groups.setdefault((row["stage"], GROUPINGS[grouping](row)), []).append(row)
+
+    print("%-24s %-32s %6s %10s %10s %10s %14s %8s" % ("Stage", grouping.capitalize(), "Runs", "p50 (s)", "p95 (s)", "CPU p50", "Peak RSS (MiB)", "Failures"))
+    for (stage_name, key), group in sorted(groups.items()):
+        succeeded = list(filter(lambda x: x["status"] == 0, group)) or group
+        print("%-24s %-32s %6i %10s %10s %10s %14.1f %8i" % (
+            stage_name,
+            key,
+            len(group),
+            seconds(percentile(list(map(lambda x: x["wall"], succeeded)), 50)),
+            seconds(percentile(list(map(lambda x: x["wall"], succeeded)), 95)),
+            seconds(percentile(list(map(lambda x: x["cpu"] or 0.0, succeeded)), 50)),
+            max(map(lambda x: x["max_rss_kib"] or 0, group)) / 1024,
+            len(group) - len(list(filter(lambda x: x["status"] == 0, group)))
+        ))
@@ -0,0 +1,111 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from .util import ar, in_thread, run_async, extract_pixz, Extraction, NonZeroExit
+from .archive import ArchiveIndex
+from .file import extraction_progress
+from .error import eprint
+
+import click
+
+import os
+import fnmatch
+import subprocess
+
+# Archive members setup leaves to be extracted just in time (see
+# FileManager.jit_extract), as shell-style patterns
+DEFAULT_EXCLUDES = ["install/share/symbiflow/arch/*"]
+
+ENVIRONMENT_MEMBER = "environment.yml"
+
+# The exclude patterns filter the tar stream as it goes by: pixz decompresses
+# the whole archive in one pass, and the members matching them are read past
+# rather than written out.
+def excluded(name, excludes):
+    return any(map(lambda pattern: fnmatch.fnmatchcase(name, pattern), excludes))
+
+@click.command('setup', help='Setup environment from .pixz file')
+@click.option('-i', '--install-dir', required=True)
+@click.option('-f', '--family', required=True)
+@click.option('--exclude', 'excludes', multiple=True, default=DEFAULT_EXCLUDES, show_default=True, help="Skip archive members matching this pattern, leaving them to be extracted on demand. May be given more than once.")
+@click.argument('pixz_archive', required=True, nargs=1)
+def setup(install_dir, family, pixz_archive, excludes):
+    family_path = os.path.join(install_dir, family)
+    env_yaml = os.path.join(family_path, "environment.yml")
+    rc_file = os.path.join(family_path, ".rc")
+    base_path = os.path.join(family_path, "install")
+    bin_file_path = os.path.join(base_path, "bin")
+
+    archive_realpath = os.path.realpath(pixz_archive)
+
+    index = ArchiveIndex(archive_realpath).load() # Listed up front, for extracting just in time later
+    skip = lambda name: name == ENVIRONMENT_MEMBER or excluded(name, excludes)
+
+    # The conda environment only needs environment.yml: it gets created while
+    # the rest of the toolchain is extracted.
+    extract_pixz(archive_realpath, family_path, [ENVIRONMENT_MEMBER])
+
+    conda_log = os.path.join(family_path, "conda.log")
+
+    async def create_environment():
+        with open(conda_log, "w") as log:
+            try:
+                await ar([
+                    "conda", "env", "create", "--verbose", "-f",
+                    env_yaml
+                ], stdout=log, stderr=subprocess.STDOUT)
+            except NonZeroExit:
+                eprint("Creating the conda environment failed: see %s." % conda_log)
+                raise
+
+    from halo import Halo # Slow to import: only needed for the spinner
+
+    text = 'Extracting toolchain and creating conda environment…'
+    with Halo(text=text, spinner='dots') as spinner:
+        # Whichever of the two fails first stops the other
+        async def provision():
+            import asyncio
+            extraction = Extraction()
+            tasks = [
+                asyncio.ensure_future(create_environment()),
+                asyncio.ensure_future(in_thread(extract_pixz, archive_realpath, family_path, [], progress=extraction_progress(spinner, text, index), started=extraction.started, skip=skip))
+            ]
+            tasks[-1].add_done_callback(lambda _: setattr(spinner, "text", 'Creating conda environment…'))
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    if task.exception() is not None:
+                        raise task.exception()
+            except BaseException:
+                tasks[0].cancel()
+                extraction.abort()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            finally:
+                index.save()
+        run_async(provision())
+
+    with open(rc_file, "w") as f:
+        f.write("# AUTOGENERATED BY SILKFLOW\n")
+
+        f.write("source $HOME/.bashrc\n")
+        f.write("export PATH=%s:$PATH\n" % bin_file_path)
+        f.write("export SYMBIFLOW_ARCH=%s\n" % family)
+        f.write("export SYMBIFLOW_BASE=%s\n" % base_path)
+        f.write("export SILKFLOW_PIXZ_ARCHIVE=%s\n" % archive_realpath)
+
+        f.write("conda activate %s\n" % family)
+
+    eprint("Done!")
@@ -0,0 +1,188 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import sys
+import json
+import time
+import functools
+import threading
+import contextlib
+import contextvars
+
+# Every subprocess launched through util.r is recorded here, tagged with the
+# flow stage it was launched from.
+records = []
+stages = []
+
+lock = threading.Lock()
+stage_var = contextvars.ContextVar("stage", default=None)
+origin = time.time()
+
+def current_stage():
+    return stage_var.get()
+
+# Separates concurrent asyncio tasks on the timeline, which otherwise all
+# share a thread. There can be no tasks if asyncio hasn't even been imported.
+def lane():
+    asyncio = sys.modules.get("asyncio")
+    try:
+        task = asyncio.current_task() if asyncio is not None else None
+    except RuntimeError:
+        task = None
+    return id(task) if task is not None else threading.get_ident()
+
+# Called with every finished stage's entry (see stage()) and the records of
+# the subprocesses it ran, e.g. by history.py
+listeners = []
+
+# The exit status an exception leaving a stage stands for
+def exception_status(exception):
+    if isinstance(exception, SystemExit):
+        if exception.code is None or isinstance(exception.code, int):
+            return exception.code or 0
+        return 1
+    return getattr(exception, "ec", None) or 1 # NonZeroExit
+
+# Tags subprocesses launched from the current thread (or asyncio task) with a
+# stage name.
+@contextlib.contextmanager
+def stage(name):
+    token = stage_var.set(name)
+    start = time.time()
+    status = 0
+    try:
+        yield
+    except BaseException as e:
+        status = exception_status(e)
+        raise
+    finally:
+        stage_var.reset(token)
+        end = time.time()
+        entry = {
+            "stage": name,
+            "start": start - origin,
+            "wall": end - start,
+            "thread": lane(),
+            "status": status
+        }
+        with lock:
+            stages.append(entry)
+            stage_records = [record for record in records if record["stage"] == name and record["thread"] == entry["thread"] and record["start"] >= entry["start"]]
+        for listener in listeners:
+            listener(entry, stage_records)
+
+def staged(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# rusage is None where it could not be collected, e.g. for processes that
+# could not be killed and reaped.
+def record(cmd, start, wall, rusage, exit_code):
+    entry = {
+        "stage": current_stage(),
+        "command": os.path.basename(cmd[0]),
+        "argv": list(cmd),
+        "start": start - origin,
+        "wall": wall,
+        "user": rusage.ru_utime if rusage is not None else None,
+        "sys": rusage.ru_stime if rusage is not None else None,
+        "max_rss_kib": rusage.ru_maxrss if rusage is not None else None,
+        "exit": exit_code,
+        "thread": lane()
+    }
+    with lock:
+        records.append(entry)
+    return entry
+
+def summary():
+    by_stage = {}
+    with lock:
+        for entry in records:
+            name = entry["stage"] or "(none)"
+            stage_summary = by_stage.setdefault(name, {
+                "processes": 0,
+                "wall": 0.0,
+                "user": 0.0,
+                "sys": 0.0,
+                "max_rss_kib": 0
+            })
+            stage_summary["processes"] += 1
+            stage_summary["wall"] += entry["wall"]
+            stage_summary["user"] += entry["user"] or 0.0
+            stage_summary["sys"] += entry["sys"] or 0.0
+            stage_summary["max_rss_kib"] = max(stage_summary["max_rss_kib"], entry["max_rss_kib"] or 0)
+    return by_stage
+
+def trace_events():
+    thread_ids = {}
+    tid = lambda thread: thread_ids.setdefault(thread, len(thread_ids) + 1)
+    pid = os.getpid()
+    microseconds = lambda seconds: int(seconds * 1000000)
+
+    events = []
+    with lock:
+        for entry in stages:
+            events.append({
+                "name": entry["stage"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": microseconds(entry["start"]),
+                "dur": microseconds(entry["wall"]),
+                "pid": pid,
+                "tid": tid(entry["thread"])
+            })
+        for entry in records:
+            events.append({
+                "name": entry["command"],
+                "cat": "subprocess",
+                "ph": "X",
+                "ts": microseconds(entry["start"]),
+                "dur": microseconds(entry["wall"]),
+                "pid": pid,
+                "tid": tid(entry["thread"]),
+                "args": {
+                    "stage": entry["stage"],
+                    "argv": " ".join(entry["argv"]),
+                    "user": entry["user"],
+                    "sys": entry["sys"],
+                    "max_rss_kib": entry["max_rss_kib"],
+                    "exit": entry["exit"]
+                }
+            })
+    return events
+
+# Writes a Chrome trace_event file (chrome://tracing, Perfetto) with the
+# per-stage summary and raw records under otherData.
+def export(path):
+    stage_summary = summary()
+    with open(path, "w") as f:
+        json.dump({
+            "traceEvents": trace_events(),
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "summary": stage_summary,
+                "records": records
+            }
+        }, f, indent=1)
+
+    print("%-24s %9s %10s %10s %10s %14s" % ("Stage", "Processes", "Wall (s)", "User (s)", "Sys (s)", "Peak RSS (MiB)"), file=sys.stderr)
+    for name, entry in stage_summary.items():
+        print("%-24s %9i %10.2f %10.2f %10.2f %14.1f" % (name, entry["processes"], entry["wall"], entry["user"], entry["sys"], entry["max_rss_kib"] / 1024), file=sys.stderr)
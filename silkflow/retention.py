@@ -0,0 +1,204 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# What becomes of a run's intermediate files and logs once it is done, from
+# --retention, SILKFLOW_RETENTION or the "retention" section of silkflow.json:
+#
+#   {
+#       "retention": {
+#           "policy": "compress",
+#           "codec": "xz",
+#           "level": 6,
+#           "rules": {"*.raw.json": "delete", "*_synth.v": "keep"}
+#       }
+#   }
+#
+#   * keep (the default): everything is left as it is
+#   * compress: intermediates and logs are compressed
+#   * final: only the bitstreams and the logs (VPR's .rpt reports too) are kept, the
+#     logs compressed
+#
+# rules override the policy for the files whose name or path matches a glob
+# pattern: keep, compress or delete. Nothing is deleted after a failed run,
+# only compressed, so it can still be looked into.
+#
+# Compressed files are streamed to and from <file>.zst (zstd, if installed)
+# or <file>.xz, and decompressed again when a command needs them as inputs.
+from .util import r, eprint
+from .config import ConfigError
+from . import config
+
+import os
+import shutil
+import fnmatch
+
+POLICIES = {
+    "keep": {"intermediate": "keep", "log": "keep"},
+    "compress": {"intermediate": "compress", "log": "compress"},
+    "final": {"intermediate": "delete", "log": "compress"}
+}
+ACTIONS = ["keep", "compress", "delete"]
+LOGS = [".log", ".rpt"] # VPR's reports are kept along with the logs
+EXTENSIONS = {"zstd": ".zst", "xz": ".xz"}
+LEVELS = {"zstd": 3, "xz": 6}
+CHUNK_SIZE = 1 << 20
+
+# zstd's Python bindings, or else its command-line tool, or None
+def zstd_backend():
+    try:
+        import zstandard # Optional
+        return zstandard
+    except ImportError:
+        pass
+    return "zstd" if shutil.which("zstd") is not None else None
+
+def default_codec():
+    return "zstd" if zstd_backend() is not None else "xz"
+
+class Policy(object):
+    def __init__(self, name="keep", codec=None, level=None, rules=None, finals=None):
+        self.name = name
+        self.codec = codec # Default: zstd if installed (looked up once needed)
+        self.level = level
+        self.rules = rules or {}
+        self.finals = finals or [] # The bitstreams, kept unless a rule says otherwise
+
+    def action(self, path, failed=False):
+        action = None
+        for pattern, rule in self.rules.items():
+            if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern):
+                action = rule
+                break
+        if action is None:
+            if path in self.finals:
+                action = "keep"
+            else:
+                action = POLICIES[self.name]["log" if path.endswith(tuple(LOGS)) else "intermediate"]
+        if action == "delete" and failed:
+            action = "compress"
+        return action
+
+    # Puts path, a file of the run at source, at destination (the same
+    # path when settling in place) as the policy has it. move puts it there
+    # as is.
+    def settle(self, path, source, destination, move, failed=False):
+        action = self.action(path, failed=failed)
+        if action == "keep":
+            if source != destination:
+                move(source, destination)
+            discard(destination, but=destination)
+        elif action == "compress":
+            codec = self.codec or default_codec()
+            level = self.level if self.level is not None else LEVELS[codec]
+            discard(destination, but=compress(source, destination, codec, level))
+        else:
+            discard(destination)
+
+# The policy from name (--retention), SILKFLOW_RETENTION or silkflow.json, in
+# that order of precedence. Raises ConfigError if anything is off.
+def load(name=None, finals=None):
+    settings = config.section("retention")
+    name = name or os.getenv("SILKFLOW_RETENTION") or settings.get("policy") or "keep"
+    if name not in POLICIES:
+        raise ConfigError("Unknown retention policy %s: should be one of %s." % (name, ", ".join(POLICIES.keys())))
+
+    codec = settings.get("codec")
+    if codec is not None and codec not in EXTENSIONS:
+        raise ConfigError("Unknown compression codec %s in %s: should be zstd or xz." % (codec, config.FILE_NAME))
+    if codec == "zstd" and zstd_backend() is None:
+        raise ConfigError("%s asks for zstd compression, but neither zstd nor the zstandard module is installed." % config.FILE_NAME)
+
+    level = settings.get("level")
+    if level is not None and type(level) != int:
+        raise ConfigError("The compression level in %s should be an integer." % config.FILE_NAME)
+
+    rules = settings.get("rules") or {}
+    if not isinstance(rules, dict):
+        raise ConfigError("\"rules\" in %s should map file patterns to keep, compress or delete." % config.FILE_NAME)
+    for pattern, action in rules.items():
+        if action not in ACTIONS:
+            raise ConfigError("Unknown retention action %s for %s: should be one of %s." % (action, pattern, ", ".join(ACTIONS)))
+
+    return Policy(name, codec=codec, level=level, rules=rules, finals=finals)
+
+# -- Compression --
+def compressed_versions(path):
+    return list(filter(os.path.exists, map(lambda x: path + x, EXTENSIONS.values())))
+
+# Deletes path and its compressed versions, but one
+def discard(path, but=None):
+    for candidate in [path] + list(map(lambda x: path + x, EXTENSIONS.values())):
+        if candidate != but and os.path.lexists(candidate):
+            os.unlink(candidate)
+
+# Streams from source to a file written atomically, keeping source's mtime
+def write_atomically(source, destination, write):
+    temporary = "%s.%i.partial" % (destination, os.getpid())
+    try:
+        with open(source, "rb") as i, open(temporary, "wb") as o:
+            write(i, o)
+        shutil.copystat(source, temporary)
+        os.replace(temporary, destination)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+    return destination
+
+def compress(source, destination, codec, level):
+    def write(i, o):
+        if codec == "xz":
+            import lzma # Only needed once compressing
+            with lzma.open(o, "wb", preset=level) as f:
+                shutil.copyfileobj(i, f, CHUNK_SIZE)
+            return
+        backend = zstd_backend()
+        if backend == "zstd":
+            r(["zstd", "-q", "-c", "-%i" % level], stdin=i, stdout=o)
+        else:
+            backend.ZstdCompressor(level=level).copy_stream(i, o, read_size=CHUNK_SIZE)
+    return write_atomically(source, destination + EXTENSIONS[codec], write)
+
+def decompress(source, destination):
+    def write(i, o):
+        if source.endswith(EXTENSIONS["xz"]):
+            import lzma # Only needed once decompressing
+            with lzma.open(i, "rb") as f:
+                shutil.copyfileobj(f, o, CHUNK_SIZE)
+            return
+        backend = zstd_backend()
+        if backend is None:
+            raise Exception("Cannot decompress %s: neither zstd nor the zstandard module is installed." % source)
+        elif backend == "zstd":
+            r(["zstd", "-q", "-d", "-c"], stdin=i, stdout=o)
+        else:
+            backend.ZstdDecompressor().copy_stream(i, o, read_size=CHUNK_SIZE)
+    return write_atomically(source, destination, write)
+
+# Decompresses those of these files that were compressed away, for a command
+# about to read them. A file that is there is newer than any compressed
+# version of it left behind, which is dropped.
+def materialize(*paths):
+    for path in paths:
+        if path is None:
+            continue
+        versions = compressed_versions(path)
+        if len(versions) == 0:
+            continue
+        if not os.path.exists(path):
+            eprint("Decompressing %s…" % versions[0])
+            decompress(versions[0], path)
+        discard(path, but=path)
@@ -0,0 +1,425 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# silkflow serve: a daemon running flow jobs for clients on a Unix socket.
+#
+# The daemon imports the flow once and keeps its state (tool lookups, archive
+# indexes, resolved architecture data, the helper script pool) warm; every job
+# runs in a worker forked from it, so jobs pay none of that again. At most
+# --jobs workers run at once, the rest wait in line.
+#
+# A client connects, sends a job as a single line of JSON:
+#
+#   {
+#       "cwd": "/absolute/path/to/project",
+#       "command": "run",
+#       "options": {"top_module": "top", "device": "hx8k-ct256", "part": "hx8k-ct256", "bit": "top.bit", "pcf": "top.pcf"},
+#       "args": ["--no-cache"],
+#       "files": ["top.v"],
+#       "env": {"PATH": "…", "SILKFLOW_RETENTION": "final", …}
+#   }
+#
+# where options are passed as --long-options (true for flags, lists for
+# repeated options) and env, if given, is the environment the job runs with
+# instead of the daemon's. The warm state is only good for one family,
+# install and archive: a job whose env asks for others is rejected. The
+# client then reads one JSON event per line until "exit":
+#
+#   {"event": "queued", "job": 1, "waiting": 0}
+#   {"event": "started", "job": 1, "pid": 1234}
+#   {"event": "stdout", "data": "…"} / {"event": "stderr", "data": "…"}
+#   {"event": "diagnostics", "errors": […], "warnings": […]}
+#   {"event": "exit", "status": 0}
+#
+# or a single {"event": "rejected", "message": "…"} for a malformed job.
+# Hanging up cancels the job. silkflow submit is a client for the command line.
+from .error import eprint, get_reporter
+from .util import cache_dir, exit_code, exit_status
+
+import click
+
+import os
+import sys
+import json
+import codecs
+import signal
+import socket
+
+def default_socket():
+    return os.path.join(os.getenv("XDG_RUNTIME_DIR") or cache_dir(), "silkflow.sock")
+
+# What the daemon's warm state depends on, as the flow reads it from env
+def warm_settings(env):
+    return {
+        "SYMBIFLOW_ARCH": env.get("SYMBIFLOW_ARCH") or "ice40",
+        "SYMBIFLOW_BASE": env.get("SYMBIFLOW_BASE") or "/opt/symbiflow",
+        "SILKFLOW_PIXZ_ARCHIVE": env.get("SILKFLOW_PIXZ_ARCHIVE") or None
+    }
+
+# The environment a job runs with, or None for the daemon's. Raises
+# ValueError if the daemon's warm state doesn't fit it.
+def job_env(job):
+    env = job.get("env")
+    if env is None:
+        return None
+    if not isinstance(env, dict) or not all(map(lambda item: isinstance(item[0], str) and isinstance(item[1], str), env.items())):
+        raise ValueError("env must map variable names to strings")
+    wanted, warm = warm_settings(env), warm_settings(os.environ)
+    for name, value in wanted.items():
+        if value != warm[name]:
+            raise ValueError("the job has %s=%s, but the daemon was started with %s: run a daemon for it" % (name, value, warm[name]))
+    return env
+
+# Turns a job into silkflow arguments
+def job_argv(job):
+    command = job["command"]
+    if not isinstance(command, str):
+        raise ValueError("command must be a string")
+    argv = [command]
+    for name, value in (job.get("options") or {}).items():
+        flag = "--%s" % name.replace("_", "-")
+        if value is True:
+            argv.append(flag)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, list):
+            for item in value:
+                argv += [flag, str(item)]
+        else:
+            argv += [flag, str(value)]
+    argv += list(map(str, job.get("args") or []))
+    argv += list(map(str, job.get("files") or []))
+    return argv
+
+# Runs a job in a freshly forked worker. Never returns.
+def work(argv, cwd, env, stdout, stderr, diagnostics):
+    status = 70
+    try:
+        signal.set_wakeup_fd(-1)
+        for signum in [signal.SIGINT, signal.SIGTERM, signal.SIGCHLD]:
+            signal.signal(signum, signal.SIG_DFL)
+        os.setsid() # The daemon, not the terminal, decides when jobs stop
+
+        os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+        os.dup2(diagnostics, 3)
+        os.closerange(4, os.sysconf("SC_OPEN_MAX")) # The daemon's sockets and other jobs' pipes
+        sys.stdout.reconfigure(line_buffering=True)
+        sys.stderr.reconfigure(line_buffering=True)
+
+        os.chdir(cwd)
+
+        import time
+        from . import cli, flow, profiling, admission
+        from .store import ArchStore
+        from .toolchain import Toolchain
+        if env is not None:
+            # Settings read at import time are read again from the job's
+            # environment; tool lookups are redone if they may differ.
+            lookups = lambda: (os.getenv("PATH"), cache_dir())
+            daemon_lookups = lookups()
+            os.environ.clear()
+            os.environ.update(env)
+            if lookups() != daemon_lookups:
+                flow.fm.toolchain = Toolchain(flow.fm.base)
+                flow.fm.archive_index = None
+            flow.fm.store = ArchStore.from_environment()
+            admission.budget = admission.MemoryBudget.from_environment()
+        flow.current_project = os.path.basename(cwd)
+        del profiling.records[:]
+        del profiling.stages[:]
+        profiling.origin = time.time()
+
+        try:
+            cli.main(argv)
+            status = 0
+        except SystemExit as e:
+            status = exit_status(e.code)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            er = get_reporter()
+            report = json.dumps({
+                "errors": er.errors,
+                "warnings": er.warnings
+            }).encode("utf-8")
+            while len(report) != 0:
+                report = report[os.write(3, report):]
+        finally:
+            os._exit(status)
+
+class Daemon(object):
+    def __init__(self, jobs):
+        import asyncio
+        self.slots = asyncio.Semaphore(jobs)
+        self.waiting = 0
+        self.workers = set()
+        self.next_job = 1
+
+        from . import flow
+        self.flow = flow
+        flow.fm.toolchain.load()
+        if flow.fm.archive_realpath is not None:
+            flow.fm.get_archive_index().load()
+        from . import helpers
+        helpers.enabled = True
+        flow.helper_pool(wait=True) # Shared by every job's helper scripts
+
+    # Picks up what a finished job learned: tool lookups and archive member
+    # sizes are persisted by the worker, and a device's architecture data can
+    # be resolved here once all of its files are there.
+    def refresh(self, job):
+        fm = self.flow.fm
+        fm.toolchain.results = None
+        fm.toolchain.load()
+        if fm.archive_index is not None:
+            fm.archive_index.members = None
+            fm.archive_index.load()
+
+        options = job.get("options") or {}
+        device = options.get("device")
+        if device is None:
+            return
+        part = options.get("part")
+        try:
+            if all(map(os.path.exists, fm.get_device_files(self.flow.arch, device, part))):
+                fm.get_arch_info(self.flow.arch, device, part)
+        except Exception:
+            pass # The next job will find out on its own
+
+    async def open_pipe(self, fd):
+        import asyncio
+        reader = asyncio.StreamReader()
+        await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, "rb", 0))
+        return reader
+
+    async def forward(self, fd, event, send):
+        reader = await self.open_pipe(fd)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            chunk = await reader.read(64 * 1024)
+            data = decoder.decode(chunk, final=len(chunk) == 0)
+            if len(data) != 0:
+                await send(event, data=data)
+            if len(chunk) == 0:
+                return
+
+    async def run(self, job_id, argv, cwd, env, send, hangup):
+        import asyncio
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        diagnostics_r, diagnostics_w = os.pipe()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            work(argv, cwd, env, stdout_w, stderr_w, diagnostics_w)
+
+        for fd in [stdout_w, stderr_w, diagnostics_w]:
+            os.close(fd)
+        self.workers.add(pid)
+        try:
+            await send("started", job=job_id, pid=pid)
+            streams = [
+                asyncio.ensure_future(self.forward(stdout_r, "stdout", send)),
+                asyncio.ensure_future(self.forward(stderr_r, "stderr", send))
+            ]
+
+            # The worker writes its diagnostics on the way out, so the end of
+            # that pipe is the end of the job.
+            diagnostics = asyncio.ensure_future((await self.open_pipe(diagnostics_r)).read())
+            done, _ = await asyncio.wait([diagnostics, hangup], return_when=asyncio.FIRST_COMPLETED)
+            if diagnostics not in done:
+                os.kill(pid, signal.SIGTERM)
+            report = await diagnostics
+            _, wait_status = os.waitpid(pid, 0)
+            status = exit_code(wait_status)
+        finally:
+            self.workers.discard(pid)
+
+        # Tools left running in the background may hold on to the output
+        # pipes: don't wait for them.
+        _, pending = await asyncio.wait(streams, timeout=1)
+        for stream in pending:
+            stream.cancel()
+
+        try:
+            report = json.loads(report)
+        except ValueError:
+            report = {"errors": [], "warnings": []}
+        await send("diagnostics", errors=report["errors"], warnings=report["warnings"])
+        return status
+
+    async def handle(self, reader, writer):
+        import asyncio
+        async def send(event, **fields):
+            if writer.is_closing():
+                return
+            fields["event"] = event
+            writer.write((json.dumps(fields) + "\n").encode("utf-8"))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass # Seen by hangup
+
+        try:
+            try:
+                job = json.loads(await reader.readline())
+                argv = job_argv(job)
+                cwd = job.get("cwd") or ""
+                if not os.path.isabs(cwd) or not os.path.isdir(cwd):
+                    raise ValueError("cwd must be the absolute path of an existing directory")
+                env = job_env(job)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                await send("rejected", message=str(e))
+                return
+
+            job_id = self.next_job
+            self.next_job += 1
+            await send("queued", job=job_id, waiting=self.waiting)
+
+            hangup = asyncio.ensure_future(reader.read())
+            self.waiting += 1
+            try:
+                slot = asyncio.ensure_future(self.slots.acquire())
+                await asyncio.wait([slot, hangup], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                self.waiting -= 1
+            if not slot.done():
+                slot.cancel()
+                return
+            try:
+                status = await self.run(job_id, argv, cwd, env, send, hangup)
+            finally:
+                self.slots.release()
+            hangup.cancel()
+
+            self.refresh(job)
+            await send("exit", status=status)
+        finally:
+            writer.close()
+
+    def stop(self):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+async def serve_socket(socket_path, jobs):
+    import asyncio
+    daemon = Daemon(jobs)
+
+    umask = os.umask(0o077) # Only this user may submit jobs
+    try:
+        server = await asyncio.start_unix_server(daemon.handle, path=socket_path)
+    finally:
+        os.umask(umask)
+
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(signum, lambda: stopped.done() or stopped.set_result(None))
+    eprint("Listening on %s with %i worker(s)…" % (socket_path, jobs))
+    try:
+        await stopped
+    finally:
+        server.close()
+        daemon.stop()
+        os.unlink(socket_path)
+
+def connect(socket_path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        raise
+    return client
+
+@click.command('serve', help="Run flow jobs for clients on a local socket, keeping toolchain and architecture state warm between them. See silkflow/serve.py for the protocol.")
+@click.option('-s', '--socket', 'socket_path', default=None, help="Unix socket to listen on [default: $XDG_RUNTIME_DIR/silkflow.sock]")
+@click.option('-j', '--jobs', default=None, type=click.IntRange(min=1), help="Jobs to run at once; the rest wait in line [default: the number of CPUs available]")
+def serve(socket_path, jobs):
+    import asyncio
+    er = get_reporter()
+    socket_path = os.path.abspath(socket_path or default_socket())
+    jobs = jobs or len(os.sched_getaffinity(0))
+
+    if os.path.exists(socket_path):
+        try:
+            connect(socket_path).close()
+            er.add_error("A silkflow daemon is already listening on %s." % socket_path).report()
+            exit(64)
+        except OSError:
+            os.unlink(socket_path) # Left behind by a daemon that is gone
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+
+    asyncio.run(serve_socket(socket_path, jobs))
+
+@click.command('submit', help="Run a command through a silkflow serve daemon, e.g. silkflow submit run -t top …", context_settings={"ignore_unknown_options": True, "allow_interspersed_args": False})
+@click.option('-s', '--socket', 'socket_path', default=None, help="Unix socket the daemon listens on [default: $XDG_RUNTIME_DIR/silkflow.sock]")
+@click.argument('args', required=True, nargs=-1, type=click.UNPROCESSED)
+def submit(socket_path, args):
+    er = get_reporter()
+    socket_path = socket_path or default_socket()
+    try:
+        client = connect(socket_path)
+    except OSError as e:
+        er.add_error("Could not connect to a silkflow daemon on %s: %s" % (socket_path, e)).report()
+        exit(69)
+
+    env = dict(os.environ)
+    env.pop("PRINT_JSON_ERRORS", None) # Printed here, from the diagnostics
+    job = {
+        "cwd": os.getcwd(),
+        "command": args[0],
+        "args": list(args[1:]),
+        "env": env
+    }
+    client.sendall((json.dumps(job) + "\n").encode("utf-8"))
+
+    with client, client.makefile("r", encoding="utf-8") as events:
+        for line in events:
+            event = json.loads(line)
+            kind = event["event"]
+            if kind == "stdout":
+                sys.stdout.write(event["data"])
+                sys.stdout.flush()
+            elif kind == "stderr":
+                sys.stderr.write(event["data"])
+                sys.stderr.flush()
+            elif kind == "queued" and event["waiting"] != 0:
+                eprint("Waiting behind %i job(s)…" % event["waiting"])
+            elif kind == "diagnostics" and os.getenv("PRINT_JSON_ERRORS") == "1":
+                print(json.dumps({
+                    "errors": event["errors"],
+                    "warnings": event["warnings"]
+                }))
+            elif kind == "rejected":
+                er.add_error("The daemon rejected the job: %s" % event["message"]).report()
+                exit(64)
+            elif kind == "exit":
+                exit(event["status"])
+
+    er.add_error("The daemon hung up before the job finished.").report()
+    exit(69)
@@ -0,0 +1,190 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from .util import r, mkdirp, cache_dir, parse_size, hash_file, NonZeroExit
+
+import os
+import stat
+import shutil
+import hashlib
+import subprocess
+
+# A host-wide, content-addressed store for extracted architecture data.
+#
+# Files are stored once, by sha256, and hardlinked (or reflinked, across
+# filesystems that support it) into every install using them. Objects no
+# install references are evicted, least recently used first, once the store
+# goes over its budget.
+#
+# Hardlinks are counted by the object's link count. Reflinks are independent
+# files as far as the filesystem is concerned, so every reflinked copy is
+# recorded in <object>.refs/ instead, and counts for as long as it exists.
+#
+# Objects are made read-only, as modifying any one copy in place would modify
+# every install sharing it.
+class ArchStore(object):
+    def __init__(self, path=None, budget=None):
+        self.root = path or os.getenv("SILKFLOW_STORE") or cache_dir("store")
+        self.objects = os.path.join(self.root, "objects")
+        self.budget = parse_size(budget or os.getenv("SILKFLOW_STORE_BUDGET") or "50G")
+
+    # SILKFLOW_STORE=off disables the store altogether
+    @staticmethod
+    def from_environment():
+        if (os.getenv("SILKFLOW_STORE") or "").lower() in ["off", "0", "none"]:
+            return None
+        return ArchStore()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def touch(self, digest):
+        with open(self.object_path(digest) + ".used", "w"):
+            pass
+
+    def __contains__(self, digest):
+        return os.path.isfile(self.object_path(digest))
+
+    # Hardlinks source to destination, or reflinks it if they are on different
+    # filesystems. Returns "hardlink" or "reflink", or None if neither is
+    # possible.
+    @staticmethod
+    def link(source, destination):
+        temporary = "%s.%i.link" % (destination, os.getpid())
+        method = "hardlink"
+        try:
+            os.link(source, temporary)
+        except OSError:
+            try:
+                r(["cp", "--reflink=always", source, temporary], stderr=subprocess.DEVNULL)
+            except NonZeroExit:
+                return None
+            method = "reflink"
+        os.replace(temporary, destination)
+        return method
+
+    def refs_path(self, digest):
+        return self.object_path(digest) + ".refs"
+
+    # Records a reflinked copy of an object
+    def reference(self, digest, path):
+        path = os.path.abspath(path)
+        refs = self.refs_path(digest)
+        mkdirp(refs)
+        with open(os.path.join(refs, hashlib.sha256(path.encode("utf-8")).hexdigest()), "w") as f:
+            f.write(path)
+
+    # The reflinked copies of an object that still exist. Records of the ones
+    # that are gone are dropped.
+    def reflinks(self, digest):
+        refs = self.refs_path(digest)
+        try:
+            names = os.listdir(refs)
+        except OSError:
+            return 0
+        count = 0
+        for name in names:
+            try:
+                with open(os.path.join(refs, name)) as f:
+                    path = f.read()
+            except OSError:
+                continue
+            if os.path.exists(path):
+                count += 1
+            else:
+                try:
+                    os.unlink(os.path.join(refs, name))
+                except FileNotFoundError:
+                    pass
+        return count
+
+    # Places the object with the given digest at destination. Returns False if
+    # it is not in the store, or could not be linked.
+    def checkout(self, digest, destination):
+        if digest is None or digest not in self:
+            return False
+        mkdirp(os.path.dirname(destination))
+        method = self.link(self.object_path(digest), destination)
+        if method is None:
+            return False
+        if method == "reflink":
+            self.reference(digest, destination)
+        self.touch(digest)
+        return True
+
+    # Moves a freshly extracted file into the store, leaving a link to it in
+    # its place. Returns the file's digest.
+    def ingest(self, path):
+        digest = hash_file(path)
+        if digest in self:
+            method = self.link(self.object_path(digest), path)
+        else:
+            object_path = self.object_path(digest)
+            mkdirp(os.path.dirname(object_path))
+            mode = os.stat(path).st_mode
+            os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+            method = self.link(path, object_path)
+            if method is None:
+                os.chmod(path, mode)
+                return digest
+        if method == "reflink":
+            self.reference(digest, path)
+        self.touch(digest)
+        return digest
+
+    def entries(self):
+        entries = []
+        if not os.path.isdir(self.objects):
+            return entries
+        for prefix in os.listdir(self.objects):
+            directory = os.path.join(self.objects, prefix)
+            for name in os.listdir(directory):
+                if name.endswith(".used") or name.endswith(".link") or name.endswith(".refs"):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    object_stat = os.stat(path)
+                except OSError:
+                    continue # Evicted meanwhile
+                try:
+                    used = os.stat(path + ".used").st_mtime
+                except OSError:
+                    used = 0
+                entries.append({
+                    "digest": name,
+                    "size": object_stat.st_size,
+                    "references": object_stat.st_nlink - 1 + self.reflinks(name),
+                    "used": used
+                })
+        return entries
+
+    # Returns the number of bytes freed
+    def evict(self):
+        entries = self.entries()
+        total = sum(map(lambda x: x["size"], entries))
+        freed = 0
+        unreferenced = sorted(filter(lambda x: x["references"] == 0, entries), key=lambda x: x["used"])
+        for entry in unreferenced:
+            if total - freed <= self.budget:
+                break
+            object_path = self.object_path(entry["digest"])
+            try:
+                os.unlink(object_path)
+                os.unlink(object_path + ".used")
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(self.refs_path(entry["digest"]), ignore_errors=True)
+            freed += entry["size"]
+        return freed
@@ -0,0 +1,107 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from .util import r, mkdirp, cache_dir
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+def mtime(path):
+    if path is None:
+        return None
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+# Tool lookups (where a tool is, what a tool prints), done at most once per
+# process and persisted per install so later invocations skip them entirely.
+#
+# The results file is keyed by the install base and PATH; every result is
+# stored with the mtime of the tool it came from and discarded once the tool
+# changes.
+class Toolchain(object):
+    def __init__(self, base):
+        self.base = os.path.realpath(base)
+
+        identity = hashlib.sha256(("%s:%s" % (self.base, os.getenv("PATH") or "")).encode("utf-8")).hexdigest()
+        self.path = cache_dir("toolchains", "%s.json" % identity[:32])
+
+        self.results = None
+        self.validated = set()
+        self.lock = threading.RLock()
+
+    def load(self):
+        if self.results is None:
+            try:
+                with open(self.path) as f:
+                    self.results = json.load(f)
+            except (OSError, ValueError):
+                self.results = {}
+        return self.results
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        try:
+            mkdirp(directory)
+            fd, temporary = tempfile.mkstemp(prefix=".toolchain-", dir=directory)
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.results, f, indent=1)
+            os.replace(temporary, self.path)
+        except OSError:
+            pass # Only an optimization
+
+    # compute() returns (value, path of the tool the value came from)
+    def lookup(self, name, compute):
+        with self.lock:
+            results = self.load()
+            entry = results.get(name)
+            if entry is not None and name in self.validated:
+                return entry["value"]
+            if entry is not None and entry["tool"] is not None and mtime(entry["tool"]) == entry["mtime"]:
+                self.validated.add(name)
+                return entry["value"]
+
+            value, tool = compute()
+            if value is None:
+                return None
+            results[name] = {
+                "value": value,
+                "tool": tool,
+                "mtime": mtime(tool)
+            }
+            self.validated.add(name)
+            self.save()
+            return value
+
+    def which(self, tool):
+        def compute():
+            path = shutil.which(tool)
+            return path, path
+        return self.lookup("which:%s" % tool, compute)
+
+    # The stripped stdout of a command that takes no input and always prints
+    # the same thing, e.g. prjxray-config.
+    def output(self, cmd):
+        def compute():
+            return r(cmd, pipe_stdout=True).strip(), self.which(cmd[0])
+        return self.lookup("output:%s" % " ".join(cmd), compute)
+
+    def prjxray_db(self):
+        return self.output(["prjxray-config"])
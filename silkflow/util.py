@@ -15,34 +15,366 @@
 # limitations under the License.
 
 import os
+import re
 import sys
+import time
+import errno
+import shutil
+import functools
+import signal
+import threading
+import hashlib
 import subprocess
 import pathlib
+import contextlib
+import collections
 from collections import namedtuple
 
+from . import profiling
+
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 class NonZeroExit(Exception):
-    def __init(self, ec):
+    def __init__(self, ec):
+        super(NonZeroExit, self).__init__(ec)
         self.ec = (ec & 255)
+        self.tail = []
 
     def __str__(self):
         return "Command had a non-zero exit (%i)" % self.ec
 
+# The returncode subprocess would give for a status from os.wait*()
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+# Reaps a process started at start (a time.time() timestamp), recording its
+# resource usage with the profiler. Returns its exit code.
+def wait(process, cmd, start):
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = exit_code(status)
+    profiling.record(cmd, start, time.time() - start, rusage, process.returncode)
+    return process.returncode
+
 # To silence stderr, pass it the expression open(os.devnull, "w")
-def r(cmd, pipe_stdout=False, binary=False, stdout=None, stderr=None, **kwargs):
+#
+# started, if provided, is called with the Popen object once the process is
+# running, for callers that may need to signal it.
+#
+# Output can also be captured as a stream instead of being buffered whole:
+# stdout (or stderr, with stream_stderr) is read line by line and is
+#   * appended to the file at log as it arrives,
+#   * passed to on_line as a string,
+#   * kept in a ring buffer of the last tail lines, which gets printed if the
+#     command fails and is attached to the NonZeroExit exception.
+def r(cmd, pipe_stdout=False, binary=False, stdout=None, stderr=None, started=None, log=None, on_line=None, tail=0, stream_stderr=False, **kwargs):
+    if pipe_stdout: # Overrides stdout option
+        stdout = subprocess.PIPE
+
+    streaming = log is not None or on_line is not None or tail != 0
+    if streaming:
+        if pipe_stdout:
+            raise Exception("Output cannot be both streamed and piped.")
+        if stream_stderr:
+            stderr = subprocess.PIPE
+        else:
+            stdout = subprocess.PIPE
+    last_lines = collections.deque(maxlen=tail) if tail else None
+
+    output = None
+    start = time.time()
+    with subprocess.Popen(cmd, stdout=stdout, stderr=stderr, **kwargs) as process:
+        if started is not None:
+            started(process)
+        try:
+            if streaming:
+                stream = process.stderr if stream_stderr else process.stdout
+                with (open(log, "ab") if log is not None else contextlib.nullcontext()) as log_file:
+                    for raw_line in stream:
+                        if log_file is not None:
+                            log_file.write(raw_line)
+                        line = raw_line.decode("utf-8", errors="replace").rstrip("\r\n")
+                        if last_lines is not None:
+                            last_lines.append(line)
+                        if on_line is not None:
+                            on_line(line)
+            elif pipe_stdout:
+                output = process.stdout.read()
+            wait(process, cmd, start)
+        except BaseException:
+            process.kill()
+            raise
+
+    if process.returncode != 0:
+        eprint(("Command had a non-zero exit (%i): " % (process.returncode & 255)) + " ".join(cmd) )
+        if last_lines:
+            eprint("Last %i lines of output:" % len(last_lines))
+            for line in last_lines:
+                eprint("    %s" % line)
+        error = NonZeroExit(process.returncode)
+        error.tail = list(last_lines or [])
+        raise error
+    if pipe_stdout:
+        if binary:
+            return output
+        else:
+            return output.decode("utf-8")
+
+# -- Async --
+# asyncio is imported by each function rather than up here: it is slow to
+# import and most commands never need it.
+#
+# An asyncio counterpart to r() for commands that may run concurrently: each
+# command runs in its own process group so it can be cleanly killed on
+# cancellation (Ctrl-C, SIGTERM, a failure elsewhere) or on timeout, and the
+# number of concurrently running commands is bounded by run_async.
+#
+# Only VPR seed sweeps and setup use it: every other stage of the flow reads
+# the previous stage's outputs (constraints need the packed netlist, and so
+# on), so there is nothing left for it to overlap.
+class CommandTimeout(NonZeroExit):
+    def __init__(self, timeout):
+        super(CommandTimeout, self).__init__(124)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command timed out after %is" % self.timeout
+
+KILL_GRACE_PERIOD = 5
+async_semaphore = None
+
+# reaping: the future of the process being reaped
+async def kill_process_group(process, reaping):
+    import asyncio
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(reaping), KILL_GRACE_PERIOD)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+async def ar(cmd, pipe_stdout=False, binary=False, stdout=None, stderr=None, timeout=None, **kwargs):
+    import asyncio
     if pipe_stdout: # Overrides stdout option
         stdout = subprocess.PIPE
-    result = subprocess.run(cmd, stdout=stdout, stderr=stderr, **kwargs)
-    if result.returncode != 0:
-        eprint(("Command had a non-zero exit (%i): " % (result.returncode & 255)) + " ".join(cmd) )
-        raise NonZeroExit(result.returncode)
+
+    if async_semaphore is not None:
+        await async_semaphore.acquire()
+    try:
+        start = time.time()
+        process = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, start_new_session=True, **kwargs)
+
+        # Reaped with os.wait4() on a worker thread rather than by asyncio's
+        # child watcher, which drops the resource usage the profiler records
+        def communicate():
+            output = None
+            if pipe_stdout:
+                with process.stdout:
+                    output = process.stdout.read()
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = exit_code(status)
+            return output, rusage
+        reaping = asyncio.ensure_future(asyncio.get_event_loop().run_in_executor(None, communicate))
+
+        try:
+            output, _ = await asyncio.wait_for(asyncio.shield(reaping), timeout)
+        except asyncio.TimeoutError:
+            await kill_process_group(process, reaping)
+            eprint(("Command timed out after %is: " % timeout) + " ".join(cmd))
+            raise CommandTimeout(timeout)
+        except BaseException:
+            await asyncio.shield(kill_process_group(process, reaping))
+            raise
+        finally:
+            # Here rather than on the worker thread, which is outside the
+            # stage and task the command was run from
+            rusage = None
+            if reaping.done() and reaping.exception() is None:
+                rusage = reaping.result()[1]
+            profiling.record(cmd, start, time.time() - start, rusage, process.returncode)
+    finally:
+        if async_semaphore is not None:
+            async_semaphore.release()
+
+    if process.returncode != 0:
+        eprint(("Command had a non-zero exit (%i): " % (process.returncode & 255)) + " ".join(cmd) )
+        raise NonZeroExit(process.returncode)
     if pipe_stdout:
         if binary:
-            return result.stdout
+            return output
         else:
-            return result.stdout.decode("utf-8")
+            return output.decode("utf-8")
+
+# Runs a blocking function (such as a stage function) on a worker thread so it
+# can be awaited alongside other work.
+async def in_thread(fn, *args, **kwargs):
+    import asyncio
+    return await asyncio.get_event_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+# Runs a coroutine to completion with at most concurrency commands started by
+# ar() running at once. SIGTERM cancels the coroutine like Ctrl-C does, so
+# that no commands are left running.
+def run_async(coroutine, concurrency=None):
+    import asyncio
+    async def main():
+        global async_semaphore
+        async_semaphore = asyncio.Semaphore(concurrency or os.cpu_count() or 1)
+        task = asyncio.ensure_future(coroutine)
+        loop = asyncio.get_event_loop()
+        previous_handler = signal.getsignal(signal.SIGTERM)
+        loop.add_signal_handler(signal.SIGTERM, task.cancel)
+        try:
+            return await task
+        finally:
+            loop.remove_signal_handler(signal.SIGTERM)
+            signal.signal(signal.SIGTERM, previous_handler)
+            async_semaphore = None
+    try:
+        return asyncio.run(main())
+    except asyncio.CancelledError:
+        raise SystemExit(128 + signal.SIGTERM)
+
+# The exit status a SystemExit with this code would give
+def exit_status(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    eprint(code)
+    return 1
+
+# Runs functions in forked processes of their own, at most jobs at a time, each
+# in a given directory with its output going to a log file there. A function
+# failing, even by calling exit(), only fails its own process.
+class Fanout(object):
+    def __init__(self, jobs):
+        if jobs < 1:
+            raise ValueError("Fanout needs at least one job slot, not %i." % jobs)
+        self.jobs = jobs
+        self.queue = []
+        self.running = {}
+        self.statuses = {}
+
+    # on_exit is called with the name, exit status and wall time once done
+    def submit(self, name, directory, log, fn, on_exit):
+        self.queue.append((name, directory, log, fn, on_exit))
+        self.poll()
+
+    def start(self, name, directory, log, fn, on_exit):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 70
+            try:
+                os.chdir(directory)
+                fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+                os.dup2(fd, 1)
+                os.dup2(fd, 2)
+                os.close(fd)
+                fn()
+                status = 0
+            except SystemExit as e:
+                status = exit_status(e.code)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+            finally:
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                finally:
+                    os._exit(status)
+        self.running[pid] = (name, on_exit, time.time())
+
+    # Reaps whatever finished and starts what can be. Only waits on the
+    # processes started here: other children (e.g. the helper pool) are left
+    # alone.
+    def poll(self):
+        for pid in list(self.running.keys()):
+            finished, wait_status = os.waitpid(pid, os.WNOHANG)
+            if finished == 0:
+                continue
+            name, on_exit, start = self.running.pop(pid)
+            self.statuses[name] = exit_code(wait_status)
+            on_exit(name, self.statuses[name], time.time() - start)
+        while len(self.queue) != 0 and len(self.running) < self.jobs:
+            self.start(*self.queue.pop(0))
+
+    # Returns every function's exit status by name
+    def wait(self):
+        try:
+            self.poll()
+            while len(self.running) != 0:
+                time.sleep(0.05)
+                self.poll()
+        except BaseException:
+            self.queue = []
+            for pid in self.running.keys():
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            raise
+        return self.statuses
+
+# A named pipe standing in for an input file that can only be produced once a
+# running process has made some progress: produce() is called to generate the
+# file only when the process opens the pipe for reading, and its contents are
+# then fed through the pipe.
+class DeferredInput(object):
+    def __init__(self, path, produce):
+        self.path = path
+        self.produce = produce
+        self.process = None
+        self.error = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.feed, daemon=True)
+
+    def __enter__(self):
+        os.mkfifo(self.path)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.done.set()
+        self.thread.join()
+        os.unlink(self.path)
+
+    def started(self, process):
+        self.process = process
+
+    def feed(self):
+        fd = None
+        while not self.done.is_set():
+            try:
+                # Opening the write end without a reader fails with ENXIO
+                fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                time.sleep(0.1)
+        if fd is None:
+            return
+
+        os.set_blocking(fd, True)
+        with os.fdopen(fd, "wb") as pipe:
+            try:
+                with open(self.produce(), "rb") as f:
+                    shutil.copyfileobj(f, pipe)
+            except BrokenPipeError:
+                pass
+            except Exception as e:
+                self.error = e
+                if self.process is not None:
+                    self.process.kill()
 
 def d2nt(dictionary):
     return namedtuple('result', dictionary.keys())(**dictionary)
@@ -50,23 +382,156 @@ def d2nt(dictionary):
 def mkdirp(path):
     pathlib.Path(path).mkdir(parents=True, exist_ok=True)
 
-def extract_pixz(archive, extraction_path, files):
-    pixz_file = open(archive)
+def cache_dir(*components):
+    base = os.getenv("SILKFLOW_CACHE_DIR") or os.path.join(os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "silkflow")
+    return os.path.join(base, *components)
+
+SIZE_SUFFIXES = {
+    "": 1,
+    "K": 1024,
+    "M": 1024 ** 2,
+    "G": 1024 ** 3,
+    "T": 1024 ** 4
+}
+
+# Parses a human-readable size such as 512M or 20G into bytes
+def parse_size(size):
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", str(size), flags=re.I)
+    if match is None:
+        raise ValueError("Invalid size '%s'." % size)
+    return int(float(match[1]) * SIZE_SUFFIXES[match[2].upper()])
 
+# Memoized per process for as long as the file's size and mtime don't change
+file_hashes = {}
+def hash_file(path):
+    stat = os.stat(path)
+    memo_key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key in file_hashes:
+        return file_hashes[memo_key]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    file_hashes[memo_key] = digest.hexdigest()
+    return file_hashes[memo_key]
+
+# Splits args into lists short enough to pass on a single command line, with
+# the current environment, without running into ARG_MAX. Half of the space is
+# left as headroom.
+def argv_batches(args, reserved=0):
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (ValueError, OSError):
+        arg_max = 128 * 1024
+    pointer_size = 8
+    environment_size = sum(map(lambda item: len(item[0]) + len(item[1]) + 2 + pointer_size, os.environ.items()))
+    limit = max(4096, (arg_max - environment_size) // 2 - reserved)
+
+    batch = []
+    batch_size = 0
+    for arg in args:
+        arg_size = len(arg.encode("utf-8")) + 1 + pointer_size
+        if len(batch) != 0 and batch_size + arg_size > limit:
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(arg)
+        batch_size += arg_size
+    if len(batch) != 0:
+        yield batch
+
+# The pixz of an extraction running on another thread, so that it can be
+# stopped from this one: pass started to extract_pixz, then abort()
+class Extraction(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.process = None
+        self.aborted = False
+
+    def started(self, process):
+        with self.lock:
+            self.process = process
+            if self.aborted:
+                self.kill()
+
+    def abort(self):
+        with self.lock:
+            self.aborted = True
+            self.kill()
+
+    def kill(self):
+        if self.process is None or self.process.returncode is not None:
+            return
+        try:
+            # Not process.kill(), which would reap pixz if it has exited
+            # already, before wait() gets to
+            os.kill(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+# Streams the output of pixz straight into an in-process tar reader, so memory
+# use is bounded by the copy buffer rather than the size of the tarball.
+#
+# Long lists of files are split across as many pixz invocations as it takes to
+# stay under ARG_MAX. An empty list extracts the whole archive.
+#
+# progress, if provided, is called after every extracted member with the member
+# and the total number of bytes extracted so far.
+#
+# started, if provided, is called with every pixz Popen object once it is
+# running, for callers that may need to stop the extraction from elsewhere.
+#
+# skip, if provided, is called with the name of every member in the stream,
+# which isn't extracted if it returns True.
+def extract_pixz(archive, extraction_path, files, progress=None, started=None, skip=None):
     mkdirp(extraction_path)
 
-    tarball = r([
-        "pixz",
-        "-x"
-    ] + files, pipe_stdout=True, binary=True, stdin=pixz_file)
+    extracted = 0
+    for batch in list(argv_batches(files, reserved=len("pixz -x "))) or [[]]:
+        extracted = extract_pixz_batch(archive, extraction_path, batch, progress, extracted, started, skip)
+
+def extract_pixz_batch(archive, extraction_path, files, progress, extracted, started=None, skip=None):
+    import tarfile
+
+    pixz_cmd = ["pixz", "-x"] + files
+    start = time.time()
+    with open(archive, "rb") as pixz_file:
+        pixz_process = subprocess.Popen(pixz_cmd, stdin=pixz_file, stdout=subprocess.PIPE)
+    if started is not None:
+        started(pixz_process)
 
-    tar_process = subprocess.Popen([
-        "tar",
-        "-x",
-        "-C", extraction_path
-    ], stdin=subprocess.PIPE)
+    extract_kwargs = {}
+    if hasattr(tarfile, "tar_filter"):
+        extract_kwargs["filter"] = "tar"
 
-    tar_process.stdin.write(tarball)
-    tar_process.stdin.close()
+    try:
+        with tarfile.open(fileobj=pixz_process.stdout, mode="r|") as tarball:
+            tarball.copybufsize = 1024 * 1024
+            for member in tarball:
+                if skip is not None and skip(member.name):
+                    continue # Read past, not written
+                tarball.extract(member, extraction_path, **extract_kwargs)
+                extracted += member.size
+                if progress is not None:
+                    progress(member, extracted)
+    except BaseException as e:
+        # A failure in pixz usually manifests as a truncated tarball: report
+        # pixz's exit code rather than tar's confusion where possible.
+        # Not poll() or kill(), which would reap pixz if it has exited
+        # already, before wait() gets to
+        try:
+            os.kill(pixz_process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        pixz_process.stdout.close()
+        pixz_failed = wait(pixz_process, pixz_cmd, start) not in [0, -signal.SIGKILL]
+        if pixz_failed and isinstance(e, Exception):
+            eprint(("Command had a non-zero exit (%i): " % (pixz_process.returncode & 255)) + "pixz -x")
+            raise NonZeroExit(pixz_process.returncode)
+        raise
 
-    tar_process.wait()
+    pixz_process.stdout.close()
+    if wait(pixz_process, pixz_cmd, start) != 0:
+        eprint(("Command had a non-zero exit (%i): " % (pixz_process.returncode & 255)) + "pixz -x")
+        raise NonZeroExit(pixz_process.returncode)
+    return extracted
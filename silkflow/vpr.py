@@ -14,10 +14,43 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .util import r, eprint
+from .util import r, ar, eprint, NonZeroExit
+from .watchdog import RouteAbandoned
+from . import admission, config, watchdog
 import os
+import re
+import contextlib
+import shutil
+import subprocess
 
-def get_options(tool, arch, out_noisy_warnings):
+LOG_TAIL_LINES = 50
+
+# Named option sets layered over the base options below: an option set to
+# None is dropped. Projects can override them, or add their own, in
+# silkflow.json (see select_profile).
+PROFILES = {
+    # Quick iterations: gives up early on designs that won't route
+    "fast": {
+        "inner_num": "0.25",
+        "max_router_iterations": "100",
+        "routing_failure_predictor": "safe"
+    },
+    "default": {},
+    # Timing closure: more placement moves and router effort
+    "quality": {
+        "inner_num": "2.0",
+        "max_router_iterations": "1000",
+        "astar_fac": "0.75"
+    },
+    # Routability over timing: the watchdog's retry for routes that won't
+    # converge
+    "relaxed": {
+        "max_criticality": "0.8",
+        "pres_fac_mult": "2.0"
+    }
+}
+
+def base_options(arch, out_noisy_warnings):
     common = [
             "--suppress_warnings", out_noisy_warnings,
 
@@ -31,7 +64,6 @@ def get_options(tool, arch, out_noisy_warnings):
             "--check_rr_graph", "off",
     ]
     if arch == "ice40":
-        eprint("WARNING: VPR and genfasm are unverified for FPGA family %s" % arch)
         return common + [
             "--router_init_wirelength_abort_threshold", "2",
             "--allow_unrelated_clustering", "off",
@@ -39,7 +71,6 @@ def get_options(tool, arch, out_noisy_warnings):
             "--astar_fac", "1.0",
         ]
     elif arch == "xc7":
-        eprint("WARNING: VPR and genfasm are unverified for FPGA family %s" % arch)
         return common + [
             "--place_delay_model", "delta_override",
             "--router_lookahead", "map",
@@ -54,35 +85,203 @@ def get_options(tool, arch, out_noisy_warnings):
                         #"sum_pin_class:check_unbuffered_edges:load_rr_indexed_data_T_values:check_rr_node:trans_per_R:check_route:set_rr_graph_tool_comment:warn_model_missing_timing"
         ]
 
+# The options of the selected profile
+profile = "default"
+profile_options = {}
+
+# Worker threads: those set with the profile or in silkflow.json, or else
+# the CPUs silkflow may run on, shared between the VPR invocations it runs at
+# once (see concurrency).
+num_workers = None
+concurrency = 1
+
+def worker_count():
+    if num_workers is not None:
+        return num_workers
+    return max(1, len(os.sched_getaffinity(0)) // max(1, concurrency))
+
+def option_value(value):
+    if isinstance(value, bool):
+        return "on" if value else "off"
+    return str(value)
+
+# Settings for the watchdog following every VPR invocation (see
+# watchdog.py), from the "watchdog" object of silkflow.json's "vpr" section.
+# If routing stops converging, VPR is run again, once, with retry_profile.
+# SILKFLOW_VPR_WATCHDOG=off disables the watchdog.
+WATCHDOG_DEFAULTS = {
+    "window": 50,
+    "wall_budget": None,
+    "cpu_budget": None,
+    "retry_profile": "relaxed"
+}
+watchdog_settings = dict(WATCHDOG_DEFAULTS)
+retry_options = None
+
+def resolve_profile(name, settings):
+    overrides = settings.get("profiles") or {}
+    if name not in PROFILES and name not in overrides:
+        raise ValueError("Unknown VPR profile '%s' (available: %s)." % (name, ", ".join(sorted(set(PROFILES.keys()) | set(overrides.keys())))))
+    if not isinstance(overrides.get(name) or {}, dict):
+        raise ValueError("VPR profile '%s' in %s should be an object." % (name, config.FILE_NAME))
+
+    options = dict(PROFILES.get(name) or {})
+    options.update(overrides.get(name) or {})
+    resolved = {}
+    for option, value in options.items():
+        resolved[option.lstrip("-")] = option_value(value) if value is not None else None
+    return resolved
+
+# Resolves a profile against silkflow.json's "vpr" section in the current
+# directory, where a profile named like a built-in one overrides its options
+# and any other name defines a new profile on top of the defaults:
+#
+#   "vpr": {
+#       "profile": "fast",             (used without --vpr-profile)
+#       "num_workers": 8,
+#       "profiles": {
+#           "fast": {"max_router_iterations": 80},
+#           "signoff": {"inner_num": 4, "bb_factor": null}
+#       },
+#       "watchdog": {"window": 30, "wall_budget": 3600, "retry_profile": null}
+#   }
+#
+# Raises ValueError for unknown profiles.
+def select_profile(name=None):
+    global profile, profile_options, num_workers, watchdog_settings, retry_options
+    settings = config.section("vpr")
+    name = name or settings.get("profile") or "default"
+    profile_options = resolve_profile(name, settings)
+    profile = name
+
+    workers = profile_options.pop("num_workers", None) or settings.get("num_workers")
+    num_workers = int(workers) if workers is not None else None
+
+    watchdog_settings = dict(WATCHDOG_DEFAULTS)
+    watchdog_settings.update(settings.get("watchdog") or {})
+    retry_profile = watchdog_settings["retry_profile"]
+    retry_options = None
+    if retry_profile is not None and retry_profile != name:
+        retry_options = resolve_profile(retry_profile, settings)
+        retry_options.pop("num_workers", None)
+
+# Runs VPR with the watchdog's retry profile instead of the selected one
+@contextlib.contextmanager
+def retrying():
+    global profile, profile_options
+    selected = profile, profile_options
+    profile, profile_options = watchdog_settings["retry_profile"], retry_options
+    try:
+        yield
+    finally:
+        profile, profile_options = selected
+
+# Runs fn, then once more with the retry profile if the watchdog stopped VPR
+# because routing wasn't converging. fn must run VPR from scratch each time.
+def with_retry(fn):
+    try:
+        return fn()
+    except RouteAbandoned as e:
+        if not e.retry or retry_options is None:
+            raise
+        eprint("Retrying with VPR profile %s…" % watchdog_settings["retry_profile"])
+    with retrying():
+        return fn()
+
+def create_watchdog():
+    if (os.getenv("SILKFLOW_VPR_WATCHDOG") or "").lower() in ["off", "0", "none"]:
+        return None
+    return watchdog.create(watchdog_settings)
+
+# threaded=False leaves out the worker count, which doesn't change VPR's
+# results: for stage cache keys.
+def get_options(tool, arch, out_noisy_warnings, threaded=True):
+    flat = base_options(arch, out_noisy_warnings)
+    options = dict(zip(flat[0::2], map(str, flat[1::2])))
+    for option, value in profile_options.items():
+        options["--%s" % option] = value
+    if threaded:
+        options["--num_workers"] = str(worker_count())
+    result = []
+    for option, value in options.items():
+        if value is not None:
+            result += [option, value]
+    return result
+
+
+def warn_unverified(arch):
+    eprint("WARNING: VPR and genfasm are unverified for FPGA family %s" % arch)
 
 def device_base(device):
     return device.split("-")[0]
 
-def run_vpr(top_module, arch, device, eblif, sdc, sfpath, args, noisy_warnings_log, stdout_log, env=None):
+def vpr_command(top_module, arch, device, eblif, sdc, sfpath, args, noisy_warnings_log, env=None):
     used_env = env or os.environ
     env_modification = used_env.copy()
     env_modification["TOP"] = top_module
 
     sdc_arg = []
     if sdc is not None:
-        sdc_arg = ["--sdc", sdc_arg]
-
-    device_name = device
+        sdc_arg = ["--sdc", sdc]
 
     arch_info = sfpath.get_arch_info(arch, device)
-    r(
-        [
-            "vpr",
-            arch_info.definition,
-            eblif,
-            "--device", device,
-            "--read_rr_graph", arch_info.rr_graph,
-            "--read_placement_delay_lookup", arch_info.place_delay   
-        ] + get_options("vpr", arch, noisy_warnings_log) + sdc_arg + args,
-        pipe_stdout=True,
-        env=env_modification
-    )
-    r(["mv", "vpr_stdout.log", stdout_log])
+    warn_unverified(arch)
+    return [
+        "vpr",
+        arch_info.definition,
+        eblif,
+        "--device", device,
+        "--read_rr_graph", arch_info.rr_graph,
+        "--read_placement_delay_lookup", arch_info.place_delay   
+    ] + get_options("vpr", arch, noisy_warnings_log) + sdc_arg + args, env_modification, arch_info.rr_graph
+
+# cwd, if set, is where VPR runs and writes its outputs: paths passed to VPR
+# are interpreted relative to it, while stdout_log is relative to silkflow's
+# own working directory.
+def run_vpr(top_module, arch, device, eblif, sdc, sfpath, args, noisy_warnings_log, stdout_log, env=None, cwd=None, started=None):
+    cmd, env_modification, rr_graph = vpr_command(top_module, arch, device, eblif, sdc, sfpath, args, noisy_warnings_log, env)
+    with admission.admit(device, rr_graph, "VPR on %s" % device):
+        vpr_watchdog = create_watchdog()
+        if vpr_watchdog is None:
+            on_line = None
+            on_started = started
+        else:
+            on_line = vpr_watchdog.line
+            def on_started(process):
+                vpr_watchdog.started(process)
+                if started is not None:
+                    started(process)
+        try:
+            r(
+                cmd,
+                tail=LOG_TAIL_LINES, # VPR writes its own complete log to vpr_stdout.log
+                env=env_modification,
+                cwd=cwd,
+                started=on_started,
+                on_line=on_line
+            )
+        except NonZeroExit as e:
+            if vpr_watchdog is not None:
+                vpr_watchdog.check(e)
+            raise
+        finally:
+            if vpr_watchdog is not None:
+                vpr_watchdog.stop()
+    shutil.move(os.path.join(cwd or ".", "vpr_stdout.log"), stdout_log)
+
+# An awaitable run_vpr, for running several VPR invocations at once: see
+# util.run_async.
+async def arun_vpr(top_module, arch, device, eblif, sdc, sfpath, args, noisy_warnings_log, stdout_log, env=None, cwd=None, timeout=None):
+    cmd, env_modification, rr_graph = vpr_command(top_module, arch, device, eblif, sdc, sfpath, args, noisy_warnings_log, env)
+    with await admission.aadmit(device, rr_graph, "VPR on %s" % device):
+        await ar(
+            cmd,
+            stdout=subprocess.DEVNULL, # VPR writes its own complete log to vpr_stdout.log
+            env=env_modification,
+            cwd=cwd,
+            timeout=timeout
+        )
+    os.replace(os.path.join(cwd or ".", "vpr_stdout.log"), stdout_log)
 
 def run_genfasm(top_module, arch, device, eblif, sfpath, args, noisy_warnings_log, stdout_log, env=None):
     used_env = env or os.environ
@@ -90,16 +289,51 @@ def run_genfasm(top_module, arch, device, eblif, sfpath, args, noisy_warnings_lo
     env_modification["TOP"] = top_module
 
     arch_info = sfpath.get_arch_info(arch, device)
-    r(
-        [
-            "genfasm",
-            arch_info.definition,
-            eblif,
-            "--device", device,
-            "--read_rr_graph", arch_info.rr_graph
-        ] + get_options("genfasm", arch, noisy_warnings_log) + args,
-        pipe_stdout=True,
-        env=env_modification
-    )
-    r(["mv", "vpr_stdout.log", stdout_log])
-    
\ No newline at end of file
+    warn_unverified(arch)
+    with admission.admit(device, arch_info.rr_graph, "genfasm on %s" % device):
+        r(
+            [
+                "genfasm",
+                arch_info.definition,
+                eblif,
+                "--device", device,
+                "--read_rr_graph", arch_info.rr_graph
+            ] + get_options("genfasm", arch, noisy_warnings_log) + args,
+            tail=LOG_TAIL_LINES, # VPR writes its own complete log to vpr_stdout.log
+            env=env_modification
+        )
+    shutil.move("vpr_stdout.log", stdout_log)
+    
+
+metric_rx = {
+    "critical_path": [
+        r"Final critical path(?: delay)?(?: \(least slack\))?:\s*([\d.]+)\s*ns",
+        r"Placement estimated critical path delay(?: \(least slack\))?:\s*([\d.]+)\s*ns"
+    ],
+    "wirelength": [
+        r"Total wirelength:\s*(\d+)",
+        r"BB estimate of min-dist \(placement\) wire length:\s*(\d+)"
+    ]
+}
+
+# Extracts the critical path delay (ns) and wirelength from a VPR log,
+# preferring post-routing figures over placement estimates. Missing metrics
+# are None. The log is scanned a line at a time, keeping the last match of
+# every expression, as it can run into hundreds of megabytes.
+def parse_vpr_metrics(log):
+    expressions = [(metric, i, re.compile(expression)) for metric, candidates in metric_rx.items() for i, expression in enumerate(candidates)]
+    last = {}
+    with open(log, errors="replace") as f:
+        for line in f:
+            for metric, i, expression in expressions:
+                match = expression.search(line)
+                if match is not None:
+                    last[(metric, i)] = match.group(1)
+    metrics = {}
+    for metric, candidates in metric_rx.items():
+        metrics[metric] = None
+        for i in range(len(candidates)):
+            if (metric, i) in last:
+                metrics[metric] = float(last[(metric, i)])
+                break
+    return metrics
@@ -0,0 +1,182 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from .util import eprint, NonZeroExit
+
+import os
+import re
+import sys
+import time
+import signal
+import threading
+
+# "# Packing", "# Placement took 1.2 seconds"…
+phase_rx = re.compile(r"^# ([A-Z][\w ]*?)(?: took [\d.]+ seconds.*)?$")
+
+# A row of the placer's or router's progress table: both start with an
+# iteration number. Router rows have the overused RR nodes as "N ( x.xxx%)".
+row_rx = re.compile(r"^\s*(\d+)\s+[\d.]+\s")
+overused_rx = re.compile(r"\s(\d+)\s*\(\s*[\d.]+%\)")
+
+# Raised when the watchdog killed VPR. retry is True if routing was just not
+# converging, in which case another profile may well do better.
+class RouteAbandoned(NonZeroExit):
+    def __init__(self, reason, retry=False):
+        super(RouteAbandoned, self).__init__(124)
+        self.reason = reason
+        self.retry = retry
+
+    def __str__(self):
+        return "VPR abandoned: %s" % self.reason
+
+# Seconds of CPU time used by a process (and its threads) so far, or None
+# where that can't be told
+def cpu_time(pid):
+    try:
+        with open("/proc/%i/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+# Follows a VPR invocation through its output: shows its progress, and kills
+# it when routing stops converging or it goes over its time budgets.
+#
+#   * window: iterations the router gets to bring down its lowest count of
+#     overused routing resources before it is considered stuck
+#   * wall_budget, cpu_budget: seconds
+#
+# VPR's own routing failure predictor is off in every profile but fast: it
+# gives up on designs that do route, eventually.
+class VprWatchdog(object):
+    def __init__(self, window=None, wall_budget=None, cpu_budget=None, spinner=None):
+        self.window = window
+        self.wall_budget = wall_budget
+        self.cpu_budget = cpu_budget
+        self.spinner = spinner
+
+        self.process = None
+        self.reason = None
+        self.retry = False
+        self.phase = None
+        self.iteration = 0
+        self.overused = None
+        self.best = None
+        self.best_iteration = 0
+
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start = time.time()
+
+    def started(self, process):
+        self.process = process
+        self.start = time.time()
+        if self.wall_budget is not None or self.cpu_budget is not None:
+            self.thread = threading.Thread(target=self.watch_budgets, daemon=True)
+            self.thread.start()
+
+    def abort(self, reason, retry=False):
+        if self.reason is not None:
+            return
+        self.reason = reason
+        self.retry = retry
+        if self.spinner is not None:
+            self.spinner.stop()
+        eprint("Stopping VPR: %s." % reason)
+        if self.process is not None:
+            # Not process.kill(), which would reap VPR if it has exited
+            # already, before util.wait() gets to
+            os.kill(self.process.pid, signal.SIGKILL)
+
+    def watch_budgets(self):
+        while not self.stopped.wait(1.0):
+            wall = time.time() - self.start
+            if self.wall_budget is not None and wall > self.wall_budget:
+                self.abort("it has run for over %is" % self.wall_budget)
+                return
+            if self.cpu_budget is not None:
+                cpu = cpu_time(self.process.pid)
+                if cpu is not None and cpu > self.cpu_budget:
+                    self.abort("it has used over %is of CPU time" % self.cpu_budget)
+                    return
+
+    def show(self):
+        if self.spinner is None:
+            return
+        if self.phase == "Routing" and self.overused is not None:
+            self.spinner.text = "Routing: iteration %i, %i overused nodes (best: %i)" % (self.iteration, self.overused, self.best)
+        elif self.phase == "Placement" and self.iteration != 0:
+            self.spinner.text = "Placement: iteration %i" % self.iteration
+        elif self.phase is not None:
+            self.spinner.text = "%s…" % self.phase
+
+    def line(self, line):
+        match = phase_rx.match(line)
+        if match is not None:
+            if " took " not in line and self.phase != match[1]:
+                self.phase = match[1]
+                self.iteration = 0
+                self.overused = None
+                self.show()
+            return
+
+        match = row_rx.match(line)
+        if match is None:
+            return
+        iteration = int(match[1])
+        if self.phase != "Routing":
+            self.iteration = iteration
+            self.show()
+            return
+
+        overused = overused_rx.search(line)
+        if overused is None:
+            return
+        if iteration <= self.iteration or self.best is None: # A new routing attempt
+            self.best = None
+            self.best_iteration = iteration
+        self.iteration = iteration
+        self.overused = int(overused[1])
+        if self.best is None or self.overused < self.best:
+            self.best = self.overused
+            self.best_iteration = iteration
+        self.show()
+
+        if self.window and self.overused != 0 and iteration - self.best_iteration >= self.window:
+            self.abort("routing has not gone below %i overused nodes in %i iterations" % (self.best, self.window), retry=True)
+
+    def stop(self):
+        self.stopped.set()
+        if self.spinner is not None:
+            self.spinner.stop()
+
+    # Turns VPR being killed into a RouteAbandoned
+    def check(self, error):
+        if self.reason is not None:
+            raise RouteAbandoned(self.reason, retry=self.retry) from error
+
+# A watchdog with the given settings (see vpr.select_profile). The progress
+# spinner is only shown on terminals.
+def create(settings):
+    spinner = None
+    if sys.stdout.isatty():
+        from halo import Halo # Slow to import: only needed for the spinner
+        spinner = Halo(text="Starting VPR…", spinner='dots').start()
+    return VprWatchdog(
+        window=settings.get("window"),
+        wall_budget=settings.get("wall_budget"),
+        cpu_budget=settings.get("cpu_budget"),
+        spinner=spinner
+    )
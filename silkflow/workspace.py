@@ -0,0 +1,129 @@
+# Copyright 2021 efabless Corporation
+#
+# Author: Mohamed Gaber <mohamed.gaber@efabless.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from .util import mkdirp
+from . import history
+
+import os
+import glob
+import errno
+import shutil
+import tempfile
+
+# The files in directory matching these glob patterns, in the order the
+# patterns are in, relative to directory
+def declared(directory, patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isabs(pattern):
+            continue # Written in place
+        for path in sorted(glob.glob(os.path.join(glob.escape(directory), pattern))):
+            relative = os.path.relpath(path, directory)
+            if os.path.isfile(path) and relative not in paths:
+                paths.append(relative)
+    return paths
+
+# Where to create workspaces, from --scratch or SILKFLOW_SCRATCH: a
+# directory, "shm" for /dev/shm, or "off" to run in the project directory
+# itself. None if off. By default, workspaces are hidden directories of the
+# project directory.
+def scratch_root(setting=None):
+    setting = setting or os.getenv("SILKFLOW_SCRATCH") or ""
+    if setting.lower() in ["off", "0", "none"]:
+        return None
+    if setting.lower() in ["shm", "tmpfs"]:
+        return "/dev/shm"
+    return setting or "."
+
+# The workspace the flow is running in, if any
+current = None
+
+# The directory the flow was started from, which relative paths given to it
+# (and to the tools it runs) are relative to
+def project_directory():
+    return current.project if current is not None else os.getcwd()
+
+# A private scratch directory a flow runs in, so flows sharing a project
+# directory don't overwrite each other's intermediate files. Once done, with
+# or without success, the flow's declared outputs are moved (or copied, from
+# another filesystem) back into the project directory, each replacing its
+# previous version atomically.
+#
+# Paths the flow is given must be absolute, as it runs from the workspace.
+# Tools that resolve paths of their own (yosys, for `include) can still be
+# run from project_directory().
+#
+# On the way back, the outputs are kept, compressed or deleted as the
+# retention policy, if any, has it (see retention.Policy). With no root, the
+# flow runs in the project directory and the policy is applied in place.
+class Workspace(object):
+    def __init__(self, root, outputs, policy=None):
+        self.project = os.getcwd()
+        self.root = os.path.abspath(root) if root is not None else None
+        self.outputs = outputs # Glob patterns, relative to the workspace
+        self.policy = policy
+        self.path = None
+        self.previous = None
+
+    def __enter__(self):
+        global current
+        self.previous, current = current, self
+        if self.root is None:
+            self.path = self.project
+            return self
+        mkdirp(self.root)
+        self.path = tempfile.mkdtemp(prefix=".silkflow-run-", dir=self.root)
+        history.annotate(project=self.project) # Before the relative paths it hashes stop working
+        os.chdir(self.path)
+        return self
+
+    def __exit__(self, exc_type, *args):
+        global current
+        current = self.previous
+        os.chdir(self.project)
+        try:
+            self.copy_back(failed=exc_type is not None)
+        finally:
+            if self.path != self.project:
+                shutil.rmtree(self.path, ignore_errors=True)
+
+    def declared(self):
+        return declared(self.path, self.outputs)
+
+    def copy_back(self, failed=False):
+        for relative in self.declared():
+            source = os.path.join(self.path, relative)
+            destination = os.path.join(self.project, relative)
+            mkdirp(os.path.dirname(destination))
+            if self.policy is not None:
+                self.policy.settle(relative, source, destination, self.move, failed=failed)
+            elif source != destination:
+                self.move(source, destination)
+
+    # Atomically, across filesystems too
+    def move(self, source, destination):
+        temporary = "%s.%i.partial" % (destination, os.getpid())
+        try:
+            try:
+                os.rename(source, temporary)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.copy2(source, temporary)
+            os.replace(temporary, destination)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+            raise